@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+"""Local stand-ins for the servers download.py fetches from.
+
+``build_data`` writes a synthetic mirror to a directory:
+
+    blast/db/           nt and nr tarball volumes with .md5 companions,
+                        listed like NCBI's FTP directory
+    uniprot/            uniprot_sprot and uniprot_trembl .fasta.gz with a
+                        RELEASE.metalink holding their MD5s
+    genomes/refgenomes.tsv
+                        the reference genome list, in genome2srv.cgi's layout
+
+``Mirror`` serves it over HTTP, and over FTP too when pyftpdlib is
+installed. The HTTP server also answers efetch.fcgi with synthetic GenBank
+records for whatever IDs are asked for, or just their accession.versions
+for rettype=acc. Every request can be delayed by a fixed latency and every
+connection limited to a bandwidth, to approximate a distant server.
+
+    python benchmarks/mirror.py DATA_DIR --latency 0.05 --bandwidth 5000000
+
+serves until interrupted, which is handy for poking at it with curl.
+"""
+import os
+import re
+import sys
+import json
+import time
+import gzip
+import random
+import logging
+import hashlib
+import tarfile
+import argparse
+import threading
+
+try:  # py3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:  # py2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler, ThrottledDTPHandler
+    from pyftpdlib.ioloop import IOLoop
+    from pyftpdlib.log import config_logging
+    from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+    ThreadedFTPServer = None
+
+CHUNK_SIZE = 64 * 1024
+LISTING_LINE = '-r--r--r--   1 ftp      anonymous %12d Jan 01 00:00 %s\r\n'
+METALINK_NS = 'http://www.metalinker.org/'
+# Bumped whenever build_data's output changes, so stale data is rebuilt
+DATA_VERSION = 1
+
+DEFAULTS = {
+    'volumes': 4,
+    'volume_size': 8 * 1024 * 1024,
+    'sprot_size': 4 * 1024 * 1024,
+    'trembl_size': 24 * 1024 * 1024,
+    'genomes': 200,
+    'genome_size': 40000,
+    'seed': 1,
+}
+
+
+def pseudo_random(seed, length):
+    """``length`` deterministic pseudo random bytes, quickly"""
+    blocks = []
+    seed = str(seed).encode('ascii')
+    for i in range(0, length, 64):
+        blocks.append(hashlib.sha512(seed + b'-' + str(i).encode('ascii')).digest())
+    return b''.join(blocks)[:length]
+
+
+def alphabet_table(letters):
+    """A bytes.translate table mapping every byte onto ``letters``"""
+    return bytes(bytearray(ord(letters[i % len(letters)]) for i in range(256)))
+
+
+DNA = alphabet_table('ACGT')
+PROTEIN = alphabet_table('ACDEFGHIKLMNPQRSTVWY')
+STOPS = ('TAA', 'TAG', 'TGA')
+COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+
+
+def md5sum(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Synthetic data
+def genome_ids(count):
+    return ['SYN%06d.1' % i for i in range(count)]
+
+
+def genbank_record(uid, size):
+    """A GenBank record for ``uid`` with a CDS every kilobase or so, the
+    same every time it is asked for."""
+    accession = uid.split('.')[0]
+    rng = random.Random(uid)
+    bases = pseudo_random(uid, size).translate(DNA).decode('ascii')
+
+    pieces = []
+    features = []
+    position = 0
+    while position < size - 3000:
+        gap = rng.randint(50, 200)
+        pieces.append(bases[position:position + gap])
+        position += gap
+        codons = rng.randint(100, 400)
+        body = bases[position + 3:position + 3 + codons * 3]
+        body = ''.join(
+            'GCT' if body[i:i + 3] in STOPS else body[i:i + 3]
+            for i in range(0, len(body), 3)
+        )
+        cds = 'ATG' + body + rng.choice(STOPS)
+        start, end = position + 1, position + len(cds)
+        if rng.random() < 0.5:
+            cds = ''.join(COMPLEMENT[x] for x in reversed(cds))
+            location = 'complement(%s..%s)' % (start, end)
+        else:
+            location = '%s..%s' % (start, end)
+        pieces.append(cds)
+        features.append((location, '%s_%04d' % (accession, len(features))))
+        position += len(cds)
+    pieces.append(bases[position:])
+    sequence = ''.join(pieces).lower()
+
+    lines = [
+        'LOCUS       %-16s %11d bp    DNA     linear   BCT 01-JAN-2000' % (accession, size),
+        'DEFINITION  Synthetic bacterium %s, complete genome.' % accession,
+        'ACCESSION   %s' % accession,
+        'VERSION     %s' % uid,
+        'KEYWORDS    .',
+        'SOURCE      Synthetic bacterium %s' % accession,
+        '  ORGANISM  Synthetic bacterium %s' % accession,
+        '            Bacteria.',
+        'FEATURES             Location/Qualifiers',
+        '     source          1..%s' % size,
+    ]
+    for location, locus_tag in features:
+        lines.append('     CDS             %s' % location)
+        lines.append('                     /locus_tag="%s"' % locus_tag)
+        lines.append('                     /product="hypothetical protein"')
+    lines.append('ORIGIN')
+    for i in range(0, size, 60):
+        chunk = sequence[i:i + 60]
+        lines.append('%9d %s' % (i + 1, ' '.join(chunk[j:j + 10] for j in range(0, len(chunk), 10))))
+    lines.append('//')
+    return '\n'.join(lines) + '\n'
+
+
+def write_volumes(directory, db, extensions, count, size):
+    """Tarball volumes of random (incompressible) index files"""
+    shares = (0.05, 0.25, 0.70)
+    for volume in range(count):
+        name = '%s.%02d' % (db, volume)
+        tarball = os.path.join(directory, name + '.tar.gz')
+        with tarfile.open(tarball, 'w:gz', compresslevel=1) as tar:
+            for extension, share in zip(extensions, shares):
+                member = os.path.join(directory, name + extension)
+                with open(member, 'wb') as handle:
+                    handle.write(os.urandom(int(size * share)))
+                tar.add(member, arcname=name + extension)
+                os.unlink(member)
+        with open(tarball + '.md5', 'w') as handle:
+            handle.write('%s  %s\n' % (md5sum(tarball), os.path.basename(tarball)))
+
+
+def write_fasta_gz(path, size, seed):
+    with gzip.open(path, 'wb', compresslevel=6) as handle:
+        written = 0
+        n = 0
+        while written < size:
+            length = 100 + n % 700
+            sequence = b'M' + pseudo_random('%s-%s' % (seed, n), length).translate(PROTEIN)
+            record = [('>sp|SYN%06d|SYN%06d_SYNTH Synthetic protein %s OX=1\n' % (n, n, n)).encode('ascii')]
+            record.extend(sequence[i:i + 60] + b'\n' for i in range(0, len(sequence), 60))
+            record = b''.join(record)
+            handle.write(record)
+            written += len(record)
+            n += 1
+
+
+def build_data(root, **params):
+    """Write the synthetic mirror to ``root``, unless it is already there
+    with the same parameters. Returns the parameters used."""
+    settings = dict(DEFAULTS)
+    settings.update((k, v) for (k, v) in params.items() if v is not None)
+    settings['version'] = DATA_VERSION
+    stamp = os.path.join(root, 'params.json')
+    if os.path.exists(stamp):
+        with open(stamp, 'r') as handle:
+            if json.load(handle) == settings:
+                return settings
+
+    blast = os.path.join(root, 'blast', 'db')
+    uniprot = os.path.join(root, 'uniprot')
+    genomes = os.path.join(root, 'genomes')
+    for directory in (blast, uniprot, genomes):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        for name in os.listdir(directory):
+            os.unlink(os.path.join(directory, name))
+
+    write_volumes(blast, 'nt', ('.nin', '.nhr', '.nsq'), settings['volumes'], settings['volume_size'])
+    write_volumes(blast, 'nr', ('.pin', '.phr', '.psq'), settings['volumes'], settings['volume_size'])
+
+    files = []
+    for db in ('sprot', 'trembl'):
+        path = os.path.join(uniprot, 'uniprot_%s.fasta.gz' % db)
+        write_fasta_gz(path, settings['%s_size' % db], '%s-%s' % (db, settings['seed']))
+        files.append('<file name="%s"><verification><hash type="md5">%s</hash></verification></file>'
+                     % (os.path.basename(path), md5sum(path)))
+    with open(os.path.join(uniprot, 'RELEASE.metalink'), 'w') as handle:
+        handle.write('<?xml version="1.0" encoding="UTF-8"?>\n<metalink xmlns="%s"><files>%s</files></metalink>\n'
+                     % (METALINK_NS, ''.join(files)))
+
+    # Three genomes to a row, as assemblies with several replicons are
+    ids = genome_ids(settings['genomes'])
+    with open(os.path.join(genomes, 'refgenomes.tsv'), 'w') as handle:
+        handle.write('#Organism\tTaxID\tAssembly\tGIs\n')
+        for i in range(0, len(ids), 3):
+            handle.write('Synthetic bacterium %s\t%s\tGCF_%09d.1\t%s\n' % (i, i, i, ','.join(ids[i:i + 3])))
+
+    with open(stamp, 'w') as handle:
+        json.dump(settings, handle)
+    return settings
+
+
+# Serving
+class Throttle(object):
+    """Delay each request by ``latency`` seconds and pace each connection
+    to ``bandwidth`` bytes per second (None for unlimited)."""
+
+    def __init__(self, latency=0, bandwidth=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def send(self, write, data):
+        start = time.time()
+        sent = 0
+        for i in range(0, len(data), CHUNK_SIZE):
+            chunk = data[i:i + CHUNK_SIZE]
+            write(chunk)
+            sent += len(chunk)
+            if self.bandwidth:
+                ahead = sent / float(self.bandwidth) - (time.time() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def http_handler(root, throttle, genome_size):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.0'
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, code, body=b'', headers=None, head_only=False):
+            self.send_response(code)
+            for (name, value) in sorted((headers or {}).items()):
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if not head_only:
+                throttle.send(self.wfile.write, body)
+
+        def serve(self, head_only):
+            time.sleep(throttle.latency)
+            path = os.path.join(root, urlparse(self.path).path.lstrip('/'))
+            if os.path.isdir(path):
+                # Directories are listed the way NCBI's FTP server lists them
+                listing = ''.join(
+                    LISTING_LINE % (os.path.getsize(os.path.join(path, x)), x)
+                    for x in sorted(os.listdir(path))
+                )
+                return self.reply(200, listing.encode('ascii'), head_only=head_only)
+            if not os.path.isfile(path):
+                return self.reply(404, head_only=head_only)
+
+            size = os.path.getsize(path)
+            start, end = 0, size - 1
+            code = 200
+            match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range') or '')
+            if match:
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(int(match.group(2)), size - 1)
+                if start >= size:
+                    return self.reply(416, head_only=head_only)
+                code = 206
+            with open(path, 'rb') as handle:
+                handle.seek(start)
+                body = handle.read(end - start + 1) if not head_only else b''
+            self.send_response(code)
+            self.send_header('Content-Length', str(end - start + 1))
+            if code == 206:
+                self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, size))
+            self.end_headers()
+            if not head_only:
+                throttle.send(self.wfile.write, body)
+
+        def do_GET(self):
+            self.serve(head_only=False)
+
+        def do_HEAD(self):
+            self.serve(head_only=True)
+
+        def do_POST(self):
+            time.sleep(throttle.latency)
+            length = int(self.headers.get('Content-Length') or 0)
+            params = parse_qs(self.rfile.read(length).decode('ascii'))
+            if not self.path.endswith('/efetch.fcgi'):
+                return self.reply(404)
+            ids = params.get('id', [''])[0].split(',')
+            if params.get('rettype', [''])[0] == 'acc':
+                body = ''.join((uid if '.' in uid else uid + '.1') + '\n' for uid in ids if uid)
+            else:
+                body = ''.join(genbank_record(uid, genome_size) for uid in ids if uid)
+            self.reply(200, body.encode('ascii'), headers={'Content-Type': 'text/plain'})
+
+    return Handler
+
+
+class Mirror(object):
+    """Serve ``root`` over HTTP, and over FTP if pyftpdlib is available.
+
+    ``http_url`` and ``ftp_url`` (None without pyftpdlib) point at the root
+    once started.
+    """
+
+    def __init__(self, root, latency=0, bandwidth=None, genome_size=DEFAULTS['genome_size']):
+        self.root = os.path.abspath(root)
+        self.throttle = Throttle(latency, bandwidth)
+        self.genome_size = genome_size
+        self.http_url = None
+        self.ftp_url = None
+        self.servers = []
+        self.ftp_thread = None
+        self.stopping = threading.Event()
+
+    def start(self):
+        httpd = ThreadingHTTPServer(('127.0.0.1', 0), http_handler(self.root, self.throttle, self.genome_size))
+        self.http_url = 'http://127.0.0.1:%s/' % httpd.server_address[1]
+        self.servers.append(httpd)
+        threading_start(httpd.serve_forever)
+
+        if ThreadedFTPServer is not None:
+            ftpd = self.ftp_server()
+            self.ftp_url = 'ftp://127.0.0.1:%s/' % ftpd.address[1]
+            self.servers.append(ftpd)
+            self.ftp_thread = threading_start(lambda: self.serve_ftp(ftpd))
+        return self
+
+    def serve_ftp(self, ftpd):
+        # In turns, so that stop() can wait for the loop to let go of its
+        # sockets before closing them; closed under a running loop, their
+        # descriptors could be handed to the next mirror's connections and
+        # be polled, or closed, by this one
+        while not self.stopping.is_set():
+            ftpd.serve_forever(timeout=0.1, blocking=False, handle_exit=False)
+
+    def ftp_server(self):
+        throttle = self.throttle
+        authorizer = DummyAuthorizer()
+        authorizer.add_anonymous(self.root)
+
+        class DTPHandler(ThrottledDTPHandler):
+            read_limit = 0
+            write_limit = throttle.bandwidth or 0
+
+        class Handler(FTPHandler):
+            def pre_process_command(self, line, cmd, arg):
+                time.sleep(throttle.latency)
+                return FTPHandler.pre_process_command(self, line, cmd, arg)
+
+        Handler.authorizer = authorizer
+        Handler.dtp_handler = DTPHandler if throttle.bandwidth else FTPHandler.dtp_handler
+        Handler.banner = 'benchmark mirror'
+        # Otherwise every command is logged
+        config_logging(level=logging.WARNING)
+        # Its own loop, not the shared IOLoop.instance(), which a mirror
+        # stopped earlier in the same process would have closed
+        return ThreadedFTPServer(('127.0.0.1', 0), Handler, ioloop=IOLoop())
+
+    def stop(self):
+        self.stopping.set()
+        if self.ftp_thread is not None:
+            self.ftp_thread.join()
+            self.ftp_thread = None
+        for server in self.servers:
+            if hasattr(server, 'close_all'):
+                server.close_all()
+            else:
+                server.shutdown()
+                server.server_close()
+        self.servers = []
+
+
+def threading_start(target):
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a synthetic NCBI/UniProt mirror')
+    parser.add_argument('data_dir', help='Where the synthetic data is (or will be) kept')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds added to every request')
+    parser.add_argument('--bandwidth', type=float, help='Bytes per second per connection')
+    for (name, value) in sorted(DEFAULTS.items()):
+        parser.add_argument('--' + name.replace('_', '-'), type=int, dest=name, help='Default %s' % value)
+    args = vars(parser.parse_args())
+
+    data_dir = args.pop('data_dir')
+    latency = args.pop('latency')
+    bandwidth = args.pop('bandwidth')
+    settings = build_data(data_dir, **args)
+    mirror = Mirror(data_dir, latency=latency, bandwidth=bandwidth, genome_size=settings['genome_size']).start()
+    sys.stderr.write('HTTP %s\nFTP  %s\n' % (mirror.http_url, mirror.ftp_url or 'unavailable, install pyftpdlib'))
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        mirror.stop()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""End to end benchmark of download.py against local stand-in servers.
+
+    python benchmarks/pipeline.py [--protocol ftp] [--latency 0.05] [--bandwidth 5000000]
+                                  [--compare benchmarks/baseline.json] [--save results.json]
+
+Synthetic data is built (once) under --data and served by mirror.py. Each of
+download.py's ncbi, uniprot and representative pipelines then runs against
+it in a fresh directory, with makeblastdb replaced by bin/makeblastdb. Wall
+time, throughput and CPU time of every step come from the XUnit report, and
+the CPU time of each pipeline from its process and everything it ran.
+
+Results saved with --save can be used as the baseline for a later run with
+--compare, which exits non-zero if a pipeline became slower than
+--tolerance allows.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+from xml.etree import ElementTree
+
+BENCHMARKS = os.path.dirname(os.path.realpath(__file__))
+REPO = os.path.dirname(BENCHMARKS)
+sys.path.insert(0, BENCHMARKS)
+import mirror  # noqa: E402
+
+PIPELINES = ('ncbi', 'uniprot', 'representative')
+# Changes smaller than this many seconds are noise, whatever the percentage
+MIN_DELTA = 0.5
+
+
+def start_pipeline(download, name):
+    if name == 'ncbi':
+        download.ncbi()
+    elif name == 'uniprot':
+        download.uniprot('sprot')
+        download.uniprot('trembl')
+    elif name == 'representative':
+        download.representative()
+    else:
+        raise ValueError('Unknown pipeline %s' % name)
+
+
+def child(name, base_url, http_url, report):
+    """Run one pipeline in this process, from the current directory"""
+    sys.path.insert(0, REPO)
+    import download
+    download.NCBI_BLAST_DB_URL = base_url + 'blast/db/'
+    download.UNIREF_URL = base_url + 'uniref/'
+    download.UNIPROT_URL = base_url + 'uniprot/'
+    download.REFERENCE_GENOMES_URL = http_url + 'genomes/refgenomes.tsv'
+    download.eutils.base_url = http_url + 'entrez/eutils/'
+
+    start_pipeline(download, name)
+    download.scheduler.run()
+    with open(report, 'w') as handle:
+        handle.write(download.xunit.serialize())
+
+
+def parse_report(path):
+    steps = []
+    for case in ElementTree.parse(path).getroot().iter('testcase'):
+        step = {
+            'classname': case.get('classname'),
+            'name': case.get('name'),
+            'time': float(case.get('time') or 0),
+            'status': 'ok',
+        }
+        if case.find('error') is not None:
+            step['status'] = 'failed'
+        elif case.find('skipped') is not None:
+            step['status'] = 'skipped'
+        for prop in case.iter('property'):
+            try:
+                step[prop.get('name')] = float(prop.get('value'))
+            except (TypeError, ValueError):
+                pass
+        steps.append(step)
+    return steps
+
+
+def run_pipeline(name, base_url, http_url, workdir):
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    os.makedirs(workdir)
+    report = os.path.join(workdir, 'report.xml')
+    env = dict(os.environ)
+    env['PATH'] = os.path.join(BENCHMARKS, 'bin') + os.pathsep + env.get('PATH', '')
+
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    with open(os.path.join(workdir, 'pipeline.log'), 'w') as log:
+        code = subprocess.call([
+            sys.executable, os.path.realpath(__file__),
+            '--child', name, '--base-url', base_url, '--http-url', http_url, '--report', report
+        ], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    wall = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    steps = parse_report(report) if os.path.exists(report) else []
+    return {
+        'wall': wall,
+        'cpu': (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime),
+        'bytes': sum(x.get('bytes', 0) for x in steps),
+        'failed': sum(1 for x in steps if x['status'] == 'failed') + (1 if code else 0),
+        'steps': steps,
+    }
+
+
+def megabytes(n):
+    return '%8.1f MB' % (n / 1e6)
+
+
+def rate(n, seconds):
+    return '%8.1f MB/s' % (n / 1e6 / seconds) if seconds else '%8s MB/s' % '-'
+
+
+def print_results(results):
+    for name, result in sorted(results['pipelines'].items()):
+        print('%-16s wall %7.2fs  cpu %7.2fs %s %s%s' % (
+            name, result['wall'], result['cpu'], megabytes(result['bytes']),
+            rate(result['bytes'], result['wall']),
+            '  %s FAILED' % result['failed'] if result['failed'] else ''))
+        for step in result['steps']:
+            line = '    %-52s %7.2fs' % ('[%s] %s' % (step['classname'], step['name']), step['time'])
+            if 'cpu_user' in step:
+                line += '  cpu %7.2fs' % (step['cpu_user'] + step.get('cpu_system', 0))
+            if 'bytes' in step:
+                line += ' %s %s' % (megabytes(step['bytes']), rate(step['bytes'], step['time']))
+            if step['status'] != 'ok':
+                line += '  ' + step['status']
+            print(line)
+
+
+def compare(results, baseline, tolerance):
+    """Print the change against ``baseline`` and return whether anything
+    regressed beyond ``tolerance``"""
+    if baseline.get('settings') != results['settings']:
+        print('Warning: the baseline was recorded with different settings, %s' % json.dumps(baseline.get('settings')))
+
+    regressed = False
+    print('\n%-16s %-6s %9s %9s %8s' % ('pipeline', '', 'baseline', 'now', 'change'))
+    for name, result in sorted(results['pipelines'].items()):
+        old = baseline.get('pipelines', {}).get(name)
+        if old is None:
+            continue
+        for metric in ('wall', 'cpu'):
+            before, now = old[metric], result[metric]
+            change = (now - before) / before * 100 if before else 0
+            worse = now > before * (1 + tolerance) and now - before > MIN_DELTA
+            regressed = regressed or worse
+            print('%-16s %-6s %8.2fs %8.2fs %+7.1f%%%s' % (
+                name, metric, before, now, change, '  REGRESSION' if worse else ''))
+    return regressed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark download.py against local stand-in servers')
+    parser.add_argument('--pipelines', default=','.join(PIPELINES),
+                        help='Comma separated subset of %s' % ', '.join(PIPELINES))
+    parser.add_argument('--protocol', choices=('ftp', 'http'),
+                        help='How tarballs and FASTA are served. Defaults to ftp, as in production, if pyftpdlib is installed')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds added to every request')
+    parser.add_argument('--bandwidth', type=float, help='Bytes per second per connection')
+    parser.add_argument('--data', default=os.path.join(tempfile.gettempdir(), 'blast-benchmark-data'),
+                        help='Where the synthetic data is kept between runs')
+    parser.add_argument('--workdir', help='Where the pipelines run. Defaults to a temporary directory, removed afterwards')
+    parser.add_argument('--save', help='Write the results here, e.g. to use as a baseline')
+    parser.add_argument('--compare', help='Baseline results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Fractional slowdown allowed before --compare fails')
+    for (name, value) in sorted(mirror.DEFAULTS.items()):
+        parser.add_argument('--' + name.replace('_', '-'), type=int, dest=name, help='Default %s' % value)
+    # Used internally to run each pipeline in its own process
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--base-url', help=argparse.SUPPRESS)
+    parser.add_argument('--http-url', help=argparse.SUPPRESS)
+    parser.add_argument('--report', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.base_url, args.http_url, args.report)
+        sys.exit(0)
+
+    data_params = dict((name, getattr(args, name)) for name in mirror.DEFAULTS)
+    sys.stderr.write('Preparing synthetic data in %s\n' % args.data)
+    settings = mirror.build_data(args.data, **data_params)
+    server = mirror.Mirror(args.data, latency=args.latency, bandwidth=args.bandwidth,
+                           genome_size=settings['genome_size']).start()
+    protocol = args.protocol or ('ftp' if server.ftp_url else 'http')
+    if protocol == 'ftp' and not server.ftp_url:
+        sys.exit('Serving FTP needs pyftpdlib')
+    base_url = server.ftp_url if protocol == 'ftp' else server.http_url
+
+    settings.update(protocol=protocol, latency=args.latency, bandwidth=args.bandwidth)
+    results = {'settings': settings, 'pipelines': {}}
+    workdir = args.workdir or tempfile.mkdtemp(prefix='blast-benchmark-')
+    try:
+        for name in args.pipelines.split(','):
+            sys.stderr.write('Running %s\n' % name)
+            results['pipelines'][name] = run_pipeline(name, base_url, server.http_url, os.path.join(workdir, name))
+    finally:
+        server.stop()
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    print_results(results)
+    if args.save:
+        with open(args.save, 'w') as handle:
+            json.dump(results, handle, indent=2, sort_keys=True)
+
+    failed = any(x['failed'] for x in results['pipelines'].values())
+    if args.compare:
+        with open(args.compare, 'r') as handle:
+            failed = compare(results, json.load(handle), args.tolerance) or failed
+    sys.exit(1 if failed else 0)
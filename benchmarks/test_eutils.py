@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Tests of eutils' pacing and retries against a scripted local server.
+
+    python -m unittest discover -s benchmarks -p 'test_*.py'
+"""
+import os
+import sys
+import time
+import logging
+import unittest
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+from eutils import EUtils, TokenBucket, HTTPError  # noqa: E402
+from mirror import ThreadingHTTPServer, threading_start  # noqa: E402
+
+try:  # py3
+    from http.server import BaseHTTPRequestHandler
+except ImportError:  # py2
+    from BaseHTTPServer import BaseHTTPRequestHandler
+
+logging.disable(logging.WARNING)
+
+
+class Script(object):
+    """Answers to give in turn, as ``(code, headers)``, then 200s. The time
+    of each request is kept in ``times``."""
+
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.times = []
+
+    def handler(self):
+        script = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                script.times.append(time.time())
+                code, headers = script.answers.pop(0) if script.answers else (200, {})
+                body = b'ok' if code == 200 else b''
+                self.send_response(code)
+                for (name, value) in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+
+class EUtilsTest(unittest.TestCase):
+
+    def serve(self, answers, **params):
+        script = Script(answers)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), script.handler())
+        threading_start(server.serve_forever)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        params.setdefault('api_key', 'key')
+        return script, EUtils(base_url='http://127.0.0.1:%s/' % server.server_address[1], **params)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(20)
+        start = time.time()
+        for _ in range(11):
+            bucket.acquire()
+        # The first is free, the other ten 1/20s apart
+        self.assertGreaterEqual(time.time() - start, 0.45)
+
+    def test_paced(self):
+        script, eutils = self.serve([])
+        for _ in range(4):
+            eutils.request('efetch.fcgi', {'id': '1'})
+        gaps = [b - a for (a, b) in zip(script.times, script.times[1:])]
+        self.assertTrue(all(gap >= 0.09 for gap in gaps), gaps)
+
+    def test_retry_after(self):
+        script, eutils = self.serve([(429, {'Retry-After': '0.5'}), (429, {'Retry-After': '0'})])
+        self.assertEqual(eutils.request('efetch.fcgi', {'id': '1'}), 'ok')
+        self.assertEqual(len(script.times), 3)
+        self.assertGreaterEqual(script.times[1] - script.times[0], 0.5)
+
+    def test_backoff(self):
+        script, eutils = self.serve([(503, {}), (500, {})], backoff=1.5)
+        self.assertEqual(eutils.request('efetch.fcgi', {'id': '1'}), 'ok')
+        self.assertEqual(len(script.times), 3)
+        self.assertGreaterEqual(script.times[1] - script.times[0], 1.5)
+        self.assertGreaterEqual(script.times[2] - script.times[1], 1.5 ** 2)
+
+    def test_retries_exhausted(self):
+        script, eutils = self.serve([(429, {'Retry-After': '0'})] * 3, retries=2)
+        with self.assertRaises(HTTPError) as raised:
+            eutils.request('efetch.fcgi', {'id': '1'})
+        self.assertEqual(raised.exception.code, 429)
+        self.assertEqual(len(script.times), 3)
+
+    def test_client_error(self):
+        script, eutils = self.serve([(400, {})])
+        with self.assertRaises(HTTPError):
+            eutils.request('efetch.fcgi', {'id': '1'})
+        self.assertEqual(len(script.times), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""Tests of fetcher.Downloader against the local mirror, over HTTP and, if
+pyftpdlib is installed, FTP.
+
+    python -m unittest discover -s benchmarks -p 'test_*.py'
+"""
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+from fetcher import Downloader  # noqa: E402
+from mirror import Mirror, ThreadedFTPServer, ThreadingHTTPServer, pseudo_random, threading_start  # noqa: E402
+
+try:  # py3
+    from http.server import BaseHTTPRequestHandler
+except ImportError:  # py2
+    from BaseHTTPServer import BaseHTTPRequestHandler
+
+logging.disable(logging.WARNING)
+SIZE = 100000
+
+
+class DownloaderTest(unittest.TestCase):
+    scheme = 'http'
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.data = pseudo_random(1, SIZE)
+        os.mkdir(os.path.join(self.root, 'served'))
+        with open(os.path.join(self.root, 'served', 'file.bin'), 'wb') as handle:
+            handle.write(self.data)
+        self.mirror = Mirror(os.path.join(self.root, 'served')).start()
+        self.url = getattr(self.mirror, self.scheme + '_url') + 'file.bin'
+        self.dest = os.path.join(self.root, 'out.bin')
+        self.part = self.dest + '.part'
+
+    def tearDown(self):
+        self.mirror.stop()
+        shutil.rmtree(self.root)
+
+    def assertFetched(self, result):
+        self.assertTrue(result.ok, result.error)
+        with open(self.dest, 'rb') as handle:
+            self.assertEqual(handle.read(), self.data)
+        self.assertFalse(os.path.exists(self.part))
+        self.assertFalse(os.path.exists(self.part + '.ranges'))
+
+    def test_whole(self):
+        result = Downloader().fetch(self.url, self.dest, digests=['md5'])
+        self.assertFetched(result)
+        self.assertEqual(result.bytes, SIZE)
+        self.assertEqual(result.digests['md5'], hashlib.md5(self.data).hexdigest())
+
+    def test_ranges(self):
+        result = Downloader(split_size=1000, ranges=4).fetch(self.url, self.dest, digests=['md5'])
+        self.assertFetched(result)
+        self.assertEqual(result.bytes, SIZE)
+        self.assertEqual(result.digests['md5'], hashlib.md5(self.data).hexdigest())
+
+    def test_resume_whole(self):
+        with open(self.part, 'wb') as handle:
+            handle.write(self.data[:30000])
+        result = Downloader().fetch(self.url, self.dest, expected={'md5': hashlib.md5(self.data).hexdigest()})
+        self.assertFetched(result)
+        self.assertEqual(result.bytes, SIZE - 30000)
+
+    def test_resume_ranges(self):
+        # The first and last of four ranges are done
+        with open(self.part, 'wb') as handle:
+            handle.write(self.data[:25000] + b'\0' * 50000 + self.data[75000:])
+        with open(self.part + '.ranges', 'w') as handle:
+            json.dump([[0, 25000], [75000, 25000]], handle)
+        result = Downloader(split_size=1000, ranges=4).fetch(self.url, self.dest)
+        self.assertFetched(result)
+        self.assertEqual(result.bytes, 50000)
+
+    def test_ranges_then_whole(self):
+        # A ranged download interrupted before any range finished leaves a
+        # full-size .part file, which must not be taken for a complete one
+        with open(self.part, 'wb') as handle:
+            handle.truncate(SIZE)
+        with open(self.part + '.ranges', 'w') as handle:
+            json.dump([], handle)
+        result = Downloader().fetch(self.url, self.dest)
+        self.assertFetched(result)
+        self.assertEqual(result.bytes, SIZE)
+
+    def test_complete_part_unverified(self):
+        # Nothing to resume, but nothing to check it against either
+        with open(self.part, 'wb') as handle:
+            handle.write(b'\0' * SIZE)
+        result = Downloader().fetch(self.url, self.dest)
+        self.assertFetched(result)
+        self.assertEqual(result.bytes, SIZE)
+
+    def test_complete_part_verified(self):
+        with open(self.part, 'wb') as handle:
+            handle.write(b'\0' * SIZE)
+        result = Downloader().fetch(self.url, self.dest, expected={'md5': hashlib.md5(self.data).hexdigest()})
+        self.assertFalse(result.ok)
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertFalse(os.path.exists(self.part))
+
+
+
+@unittest.skipIf(ThreadedFTPServer is None, 'Serving FTP needs pyftpdlib')
+class FTPDownloaderTest(DownloaderTest):
+    scheme = 'ftp'
+
+
+class TruncatedTest(unittest.TestCase):
+    """A server which hangs up part way through the body it promised"""
+
+    def setUp(self):
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header('Content-Length', str(SIZE))
+                self.end_headers()
+
+            def do_GET(self):
+                match = re.match(r'bytes=(\d+)-(\d+)$', self.headers.get('Range') or '')
+                length = int(match.group(2)) - int(match.group(1)) + 1 if match else SIZE
+                self.send_response(206 if match else 200)
+                self.send_header('Content-Length', str(length))
+                self.end_headers()
+                self.wfile.write(b'x' * (length // 2))
+
+        self.root = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading_start(self.server.serve_forever)
+        self.url = 'http://127.0.0.1:%s/file.bin' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+
+    def test_whole(self):
+        result = Downloader().fetch(self.url, os.path.join(self.root, 'out.bin'))
+        self.assertFalse(result.ok)
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'out.bin')))
+
+    def test_ranges(self):
+        result = Downloader(split_size=1000, ranges=4).fetch(self.url, os.path.join(self.root, 'out.bin'))
+        self.assertFalse(result.ok)
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'out.bin')))
+
+
+if __name__ == '__main__':
+    unittest.main()
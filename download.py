@@ -2,17 +2,33 @@
 import re
 import os
 import sys
+import json
 import time
 import glob
 import datetime
-import random
 import logging
+import itertools
+import collections
+import multiprocessing
+import threading
 import subprocess
+from xml.etree import ElementTree
+from xml.sax.saxutils import quoteattr
+
+from eutils import EUTILS_URL, EUtils
+from fetcher import ChecksumError, Downloader, parse_listing
+from journal import Journal, discard, partial
+from metrics import Publisher
+from recordcache import RecordCache
 
 try:  # py3
     from shlex import quote
+    from queue import Queue
+    from io import StringIO
 except ImportError:  # py2
     from pipes import quote
+    from Queue import Queue
+    from StringIO import StringIO
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger('dl')
@@ -21,8 +37,83 @@ SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 DATESTAMP = NOW.strftime("%Y-%V")
 DATABASES = ('uniref50', 'uniref90', 'uniref100', 'nr', 'nt', 'representative', 'trembl', 'sprot')
 DOWNLOAD_ROOT = os.getcwd()
-
-
+# Completed steps for this week's snapshot
+JOURNAL = os.path.join(DOWNLOAD_ROOT, 'journal-%s.sqlite' % DATESTAMP)
+# Where everything is fetched from. benchmarks/pipeline.py points these at
+# local stand-ins.
+NCBI_BLAST_DB_URL = 'ftp://ftp.ncbi.nih.gov/blast/db/'
+UNIREF_URL = 'ftp://ftp.ebi.ac.uk/pub/databases/uniprot/uniref/'
+UNIPROT_URL = 'ftp://ftp.uniprot.org/pub/databases/uniprot/current_release/knowledgebase/complete/'
+REFERENCE_GENOMES_URL = 'http://www.ncbi.nlm.nih.gov/genomes/Genome2BE/genome2srv.cgi?action=refgenomes&download=on&type=reference'
+# Every snapshot under DOWNLOAD_ROOT, read by gen_galaxy_loc.py
+CATALOG = os.path.join(DOWNLOAD_ROOT, 'catalog.json')
+SNAPSHOT_DIR = re.compile(r'^\d{4}-\d{2}$')
+# Number of steps which may run at once, and how many of those may hit any
+# one resource concurrently. Steps without a resource only count against
+# WORKERS.
+WORKERS = 6
+RESOURCE_LIMITS = {
+    'network': 3,
+    'cpu': 2,
+    'disk': 2,
+}
+# Built in downloader settings. Concurrent volumes are bounded by the network
+# limit above. Files larger than SPLIT_SIZE bytes are fetched as SPLIT_RANGES
+# concurrent byte ranges; None disables splitting.
+CONNECTIONS_PER_HOST = 4
+# Downloads are checked against the published MD5 as they stream in. Any
+# other hashlib digests listed here are computed alongside and reported.
+EXTRA_DIGESTS = ()
+SPLIT_SIZE = None
+SPLIT_RANGES = 4
+# Remove intermediates as soon as they have been used: each nt/nr tarball once
+# extracted, and the (compressed or not) FASTA once makeblastdb has built it.
+DELETE_INTERMEDIATES = True
+# Before a step starts, room is reserved for what it will write, estimated
+# from the size of the remote file it works from. It waits until the
+# filesystem has that much free beyond DISK_HEADROOM bytes, net of what the
+# steps already running have reserved. The ratios are disk used per byte
+# of the remote file.
+DISK_HEADROOM = 2 * 1024 * 1024 * 1024
+TARBALL_EXPANSION = 1.2
+# Protein FASTA to .fasta.gz, and makeblastdb output to FASTA
+FASTA_EXPANSION = 2.5
+BLASTDB_EXPANSION = 1.0
+# Pipe uniref/uniprot downloads through a decompressor straight into
+# makeblastdb, rather than writing out the decompressed FASTA first.
+STREAM_DECOMPRESS = True
+DECOMPRESS_THREADS = 4
+# Build these as several makeblastdb processes at once, each over about
+# SHARD_SIZE bytes of the FASTA, with SHARD_JOBS running side by side. The
+# shards are joined by a blastdb_aliastool alias, so they are used as one
+# database. An empty tuple builds everything with a single makeblastdb.
+SHARDED = ('trembl', 'uniref50', 'uniref90', 'uniref100')
+SHARD_SIZE = 4 * 1024 * 1024 * 1024
+SHARD_JOBS = 4
+# Link nt/nr volumes whose .md5 is unchanged in from the previous snapshot
+# rather than downloading them again.
+INCREMENTAL = True
+# E-utilities settings. With an API key NCBI allows 10 rather than 3 requests
+# per second.
+NCBI_API_KEY = os.environ.get('NCBI_API_KEY')
+NCBI_EMAIL = os.environ.get('NCBI_EMAIL')
+EFETCH_BATCH_SIZE = 200
+# Worker processes translating CDS features for the representative database
+EXPORT_JOBS = 4
+# Also keep the GenBank text of the representative genomes, as genomes.gb
+KEEP_GENBANK = False
+# Genomes fetched for the representative and canonical phage databases are
+# kept here by accession.version, so that a rebuild only fetches those which
+# are new or have a new version. The least recently used are removed beyond
+# RECORD_CACHE_SIZE bytes. None disables the cache.
+RECORD_CACHE = os.path.join(DOWNLOAD_ROOT, 'records')
+RECORD_CACHE_SIZE = 100 * 1024 * 1024 * 1024
+# Live progress while a run is going: a Prometheus textfile (name it *.prom
+# in node_exporter's textfile directory) rewritten every METRICS_INTERVAL
+# seconds and/or an HTTP endpoint on localhost. None disables either.
+METRICS_FILE = None
+METRICS_PORT = None
+METRICS_INTERVAL = 10
 
 class Timer:
     def __enter__(self):
@@ -34,6 +125,59 @@ class Timer:
         self.interval = self.end - self.start
 
 
+def wait_accounted(process):
+    """Wait for a Popen ``process`` and return ``(returncode, usage)``.
+
+    ``usage`` holds the CPU time, peak RSS and I/O of the process and
+    everything it waited for, measured for it alone, so steps running
+    concurrently in other threads do not get counted.
+    """
+    usage = {}
+    if hasattr(os, 'waitid'):
+        # Let it exit but leave it unreaped, as /proc/<pid>/io goes with it
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        try:
+            with open('/proc/%d/io' % process.pid, 'r') as handle:
+                io = dict(line.split(': ') for line in handle.read().splitlines())
+            usage['bytes_read'] = int(io['rchar'])
+            usage['bytes_written'] = int(io['wchar'])
+        except (IOError, OSError, KeyError, ValueError):
+            pass
+    _, status, rusage = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    usage['cpu_user'] = rusage.ru_utime
+    usage['cpu_system'] = rusage.ru_stime
+    # Kilobytes on Linux
+    usage['max_rss'] = rusage.ru_maxrss * 1024
+    return process.returncode, usage
+
+
+def combine_usage(usages):
+    """Usage of several processes that ran side by side, e.g. a pipeline"""
+    combined = {}
+    for usage in usages:
+        for (key, value) in usage.items():
+            if key == 'max_rss':
+                combined[key] = max(combined.get(key, 0), value)
+            else:
+                combined[key] = combined.get(key, 0) + value
+    return combined
+
+
+def usage_properties(usage, outputs=()):
+    properties = dict(usage)
+    for key in ('cpu_user', 'cpu_system'):
+        if key in properties:
+            properties[key] = '%.3f' % properties[key]
+    sizes = [os.path.getsize(x) for x in outputs if os.path.isfile(x)]
+    if sizes:
+        properties['output_size'] = sum(sizes)
+    return properties
+
+
 class XUnitReportBuilder(object):
     XUNIT_TPL = """<?xml version="1.0" encoding="UTF-8"?>
     <testsuite name="{suite_name}" tests="{total}" errors="{errors}" failures="{failures}" skip="{skips}">
@@ -41,10 +185,18 @@ class XUnitReportBuilder(object):
     </testsuite>
     """
 
-    TESTCASE_TPL = """        <testcase classname="{classname}" name="{name}" {time}><![CDATA[
+    TESTCASE_TPL = """        <testcase classname="{classname}" name="{name}" {time}>{properties}<![CDATA[
 {error}
         ]]></testcase>"""
 
+    PROPERTIES_TPL = """
+            <properties>
+{properties}
+            </properties>
+        """
+
+    PROPERTY_TPL = """                <property name={name} value={value} />"""
+
     ERROR_TPL = """            <error type="{test_name}" message="{errorMessage}"><![CDATA[
 {errorDetails}
             ]]></error>"""
@@ -54,54 +206,121 @@ class XUnitReportBuilder(object):
             'total': 0, 'errors': 0, 'failures': 0, 'skips': 0
         }
         self.test_cases = []
+        # The same results for the JSON sidecar
+        self.results = []
         self.suite_name = suite_name
+        # Steps report from scheduler worker threads
+        self.lock = threading.RLock()
 
-    def ok(self, classname, test_name, time=0):
+    def ok(self, classname, test_name, time=0, properties=None):
         log.info("OK: [%s] %s", classname, test_name)
-        self.xunit_data['total'] += 1
-        self.__add_test(test_name, classname, errors="", time=time)
+        with self.lock:
+            self.xunit_data['total'] += 1
+            self.__add_test(test_name, classname, errors="", time=time, properties=properties)
+            self.__add_result('ok', test_name, classname, time=time, properties=properties)
 
     def error(self, classname, test_name, errorMessage, errorDetails="", time=0):
         log.info("ERROR: [%s] %s", classname, test_name)
-        self.xunit_data['total'] += 1
-        self.__add_test(test_name, classname, errors=self.ERROR_TPL.format(
-            errorMessage=errorMessage, errorDetails=errorDetails, test_name=test_name), time=time)
+        with self.lock:
+            self.xunit_data['total'] += 1
+            self.__add_test(test_name, classname, errors=self.ERROR_TPL.format(
+                errorMessage=errorMessage, errorDetails=errorDetails, test_name=test_name), time=time)
+            self.__add_result('error', test_name, classname, time=time, message=errorMessage)
 
-    def failure(self, classname, test_name, errorMessage, errorDetails="", time=0):
+    def failure(self, classname, test_name, errorMessage, errorDetails="", time=0, properties=None):
         log.info("FAIL: [%s] %s", classname, test_name)
-        self.xunit_data['total'] += 1
-        self.__add_test(test_name, classname, errors=self.ERROR_TPL.format(
-            errorMessage=errorMessage, errorDetails=errorDetails, test_name=test_name), time=time)
+        with self.lock:
+            self.xunit_data['total'] += 1
+            self.__add_test(test_name, classname, errors=self.ERROR_TPL.format(
+                errorMessage=errorMessage, errorDetails=errorDetails, test_name=test_name), time=time,
+                properties=properties)
+            self.__add_result('failure', test_name, classname, time=time, properties=properties,
+                              message=errorMessage)
 
     def skip(self, classname, test_name, time=0):
         log.info("SKIP: [%s] %s", classname, test_name)
-        self.xunit_data['skips'] += 1
-        self.xunit_data['total'] += 1
-        self.__add_test(test_name, classname, errors="            <skipped />", time=time)
+        with self.lock:
+            self.xunit_data['skips'] += 1
+            self.xunit_data['total'] += 1
+            self.__add_test(test_name, classname, errors="            <skipped />", time=time)
+            self.__add_result('skipped', test_name, classname, time=time)
 
-    def __add_test(self, name, classname, errors, time=0):
+    def __add_test(self, name, classname, errors, time=0, properties=None):
         t = 'time="%s"' % time
+        props = ''
+        if properties:
+            props = self.PROPERTIES_TPL.format(properties='\n'.join(
+                self.PROPERTY_TPL.format(name=quoteattr(str(k)), value=quoteattr(str(v)))
+                for (k, v) in sorted(properties.items())
+            ))
         self.test_cases.append(
-            self.TESTCASE_TPL.format(name=name, error=errors, classname=classname, time=t))
+            self.TESTCASE_TPL.format(name=name, error=errors, classname=classname, time=t,
+                                     properties=props))
+
+    def __add_result(self, status, name, classname, time=0, properties=None, message=None):
+        result = {
+            'classname': classname,
+            'name': name,
+            'status': status,
+            'time': time,
+            'properties': dict(properties or {}),
+        }
+        if message is not None:
+            result['message'] = message
+        self.results.append(result)
+
+    def counts(self):
+        """Number of steps reported so far by status"""
+        with self.lock:
+            counts = dict.fromkeys(('ok', 'error', 'failure', 'skipped'), 0)
+            for result in self.results:
+                counts[result['status']] += 1
+            return counts
 
     def serialize(self):
-        self.xunit_data['test_cases'] = '\n'.join(self.test_cases)
-        self.xunit_data['suite_name'] = self.suite_name
-        return self.XUNIT_TPL.format(**self.xunit_data)
+        with self.lock:
+            self.xunit_data['test_cases'] = '\n'.join(self.test_cases)
+            self.xunit_data['suite_name'] = self.suite_name
+            return self.XUNIT_TPL.format(**self.xunit_data)
+
+    def serialize_json(self):
+        """The same report as JSON, for tracking step costs across runs"""
+        with self.lock:
+            return json.dumps({
+                'suite': self.suite_name,
+                'date': DATESTAMP,
+                'started': NOW.isoformat(),
+                'testcases': self.results,
+            }, indent=2, sort_keys=True)
 
 
 xunit = XUnitReportBuilder('db_downloader')
-
-for db in DATABASES:
-    subprocess.check_call([
-        'mkdir', '-p',
-        os.path.join(db, DATESTAMP)
-    ])
-
-def timedCommand(classname, testname, errormessage, test_file, command, shell=False, cwd=None):
-    if os.path.exists(test_file):
+journal = Journal(JOURNAL)
+
+
+def snapshot_dir(db):
+    """This week's directory for ``db``, created when first needed"""
+    path = os.path.join(db, DATESTAMP)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+def timedCommand(classname, testname, errormessage, test_file, command, shell=False, cwd=None, inputs=(),
+                 blastdb=None):
+    """Run ``command`` as a step which writes ``test_file``. For makeblastdb
+    pass the ``-out`` name as ``blastdb``, since which of its files get
+    written depends on the size of the database, and ``test_file`` is then
+    just the name the step is known by."""
+    if journal.completed(classname, testname, test_file):
         xunit.skip(classname, testname)
+        return True
     else:
+        # Anything already there was left behind by an interrupted run
+        discard(test_file)
+        # Commands which name their output write it under a temporary name,
+        # renamed into place only once they have succeeded.
+        staged = partial(test_file)
+        command = [staged if x == test_file else x for x in command]
         try:
             if not cwd:
                 cwd = DOWNLOAD_ROOT
@@ -112,130 +331,1078 @@ def timedCommand(classname, testname, errormessage, test_file, command, shell=Fa
                 if shell:
                     command = ' '.join(command)
 
-                subprocess.check_call(command, shell=shell, cwd=cwd)
-            xunit.ok(classname, testname, time=t.interval)
+                code, usage = wait_accounted(subprocess.Popen(command, shell=shell, cwd=cwd))
+                if code:
+                    raise subprocess.CalledProcessError(code, command)
+                if os.path.exists(staged):
+                    os.rename(staged, test_file)
+            outputs = blastdb_files(blastdb) if blastdb else [test_file]
+            if not outputs or not all(os.path.exists(x) for x in outputs):
+                xunit.failure(classname, testname, errormessage,
+                              errorDetails='Exited successfully without writing %s' % (blastdb or test_file),
+                              time=t.interval, properties=usage_properties(usage))
+                return False
+            journal.commit(classname, testname, test_file, outputs=outputs, inputs=inputs, duration=t.interval)
+            xunit.ok(classname, testname, time=t.interval, properties=usage_properties(usage, outputs))
+            return True
         except subprocess.CalledProcessError as cpe:
-            xunit.failure(classname, testname, errormessage, errorDetails=str(cpe), time=t.interval)
+            xunit.failure(classname, testname, errormessage, errorDetails=str(cpe), time=t.interval,
+                          properties=usage_properties(usage))
+            return False
+
+
+class Task(object):
+    """A single node in the step graph.
+
+    ``func`` is called with no arguments and should return False on failure
+    (timedCommand does this already). ``inputs`` and ``outputs`` are paths;
+    a task only starts once every task producing one of its inputs has
+    succeeded. ``space`` is an estimate of the bytes of disk it will use,
+    if known. Of the tasks able to start, those with the highest
+    ``priority`` go first.
+    """
+
+    def __init__(self, classname, testname, func, inputs=(), outputs=(), resource=None, space=None,
+                 priority=0):
+        self.classname = classname
+        self.testname = testname
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.resource = resource
+        self.space = space
+        self.priority = priority
+
+    def __repr__(self):
+        return '<Task [%s] %s>' % (self.classname, self.testname)
+
+
+class Scheduler(object):
+    """Runs a graph of Tasks on a bounded pool of worker threads.
+
+    Tasks may add further tasks while running (e.g. one per tarball once a
+    download has finished), so the graph does not need to be fully known up
+    front.
+
+    A task with a ``space`` estimate only starts once ``root``'s filesystem
+    has that much free beyond ``headroom`` and the reservations of running
+    tasks. Reservations are held until the task finishes, by when its
+    output shows in the free space itself.
+    """
+
+    def __init__(self, workers=WORKERS, limits=RESOURCE_LIMITS, root=DOWNLOAD_ROOT, headroom=DISK_HEADROOM):
+        self.workers = workers
+        self.available = dict(limits)
+        self.root = root
+        self.headroom = headroom
+        self.reserved = 0
+        self.cond = threading.Condition()
+        self.pending = []
+        self.producers = {}
+        self.done = set()
+        self.failed = set()
+        self.running = 0
+        # When each running task started
+        self.started = {}
+
+    def add(self, task):
+        with self.cond:
+            for output in task.outputs:
+                self.producers[os.path.normpath(output)] = task
+            self.pending.append(task)
+            # Stable, so tasks of equal priority keep the order they came in
+            self.pending.sort(key=lambda x: -x.priority)
+            self.cond.notify_all()
+        return task
+
+    def command(self, classname, testname, errormessage, test_file, command,
+                shell=False, cwd=None, inputs=(), outputs=None, resource=None, space=None, priority=0,
+                blastdb=None):
+        """Queue a timedCommand call as a task.
+
+        The task produces ``test_file`` unless ``outputs`` says otherwise.
+        """
+        if outputs is None:
+            outputs = [test_file]
+
+        def func():
+            return timedCommand(classname, testname, errormessage, test_file,
+                                command, shell=shell, cwd=cwd, inputs=inputs, blastdb=blastdb)
+        return self.add(Task(classname, testname, func, inputs=inputs, outputs=outputs,
+                             resource=resource, space=space, priority=priority))
+
+    def call(self, classname, testname, func, inputs=(), outputs=(), resource=None, space=None, priority=0):
+        """Queue a python callable as a task"""
+        return self.add(Task(classname, testname, func, inputs=inputs, outputs=outputs,
+                             resource=resource, space=space, priority=priority))
+
+    def free_space(self):
+        """Bytes that may still be written without cutting into the
+        headroom or what running tasks have reserved"""
+        stat = os.statvfs(self.root)
+        return stat.f_bavail * stat.f_frsize - self.headroom - self.reserved
+
+    def __upstream(self, task):
+        return [self.producers.get(os.path.normpath(path)) for path in task.inputs]
+
+    def __next_task(self):
+        # Must be called with self.cond held. Returns a runnable task, or
+        # None if nothing can start right now.
+        free = None
+        too_big = []
+        for task in list(self.pending):
+            upstream = [x for x in self.__upstream(task) if x is not None and x is not task]
+            if any(x in self.failed for x in upstream):
+                self.pending.remove(task)
+                self.failed.add(task)
+                xunit.error(task.classname, task.testname, 'Dependency failed',
+                            errorDetails=', '.join(repr(x) for x in upstream if x in self.failed))
+                # Other tasks may have been waiting on this one
+                self.cond.notify_all()
+                continue
+
+            if not all(x in self.done for x in upstream):
+                continue
+
+            if task.resource is not None and self.available.get(task.resource, 1) <= 0:
+                continue
+
+            if task.space:
+                if free is None:
+                    free = self.free_space()
+                if task.space > free:
+                    too_big.append(task)
+                    continue
+                self.reserved += task.space
+
+            self.pending.remove(task)
+            if task.resource in self.available:
+                self.available[task.resource] -= 1
+            self.running += 1
+            self.started[task] = time.time()
+            return task
+
+        if self.running == 0:
+            # Nothing is running that could free any space up
+            for task in too_big:
+                self.pending.remove(task)
+                self.failed.add(task)
+                xunit.error(task.classname, task.testname, 'Not enough disk space',
+                            errorDetails='Needs about %s bytes, %s available' % (task.space, free))
+            if too_big:
+                self.cond.notify_all()
+                # Tasks depending on those now fail in turn
+                return self.__next_task()
+        return None
+
+    def __worker(self):
+        while True:
+            with self.cond:
+                while True:
+                    task = self.__next_task()
+                    if task is not None:
+                        break
+                    if self.running == 0:
+                        # Nothing in flight, so nothing left pending can
+                        # ever become runnable (a dependency cycle).
+                        for stuck in self.pending:
+                            self.failed.add(stuck)
+                            xunit.error(stuck.classname, stuck.testname, 'Unsatisfiable dependencies')
+                        self.pending = []
+                        self.cond.notify_all()
+                        return
+                    self.cond.wait()
+
+            try:
+                success = task.func() is not False
+            except Exception as e:
+                log.exception('Task %r raised', task)
+                xunit.error(task.classname, task.testname, 'Unhandled exception', errorDetails=str(e))
+                success = False
+
+            with self.cond:
+                if task.resource in self.available:
+                    self.available[task.resource] += 1
+                self.running -= 1
+                del self.started[task]
+                if task.space:
+                    self.reserved -= task.space
+                if success:
+                    self.done.add(task)
+                else:
+                    self.failed.add(task)
+                self.cond.notify_all()
+
+    def status(self):
+        """``(running, pending)``, where running is a list of
+        ``(task, seconds since it started)``"""
+        now = time.time()
+        with self.cond:
+            return [(task, now - start) for (task, start) in self.started.items()], len(self.pending)
+
+    def run(self):
+        threads = [threading.Thread(target=self.__worker) for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # join() with a timeout keeps the main thread responsive to ^C
+            while thread.is_alive():
+                thread.join(1)
+        return not self.failed
+
+
+scheduler = Scheduler()
+downloader = Downloader(per_host=CONNECTIONS_PER_HOST, split_size=SPLIT_SIZE, ranges=SPLIT_RANGES)
+eutils = EUtils(api_key=NCBI_API_KEY, email=NCBI_EMAIL, base_url=EUTILS_URL, batch_size=EFETCH_BATCH_SIZE)
+record_cache = RecordCache(RECORD_CACHE, RECORD_CACHE_SIZE) if RECORD_CACHE else None
+# Volumes linked in from the previous snapshot, per classname
+REUSED = {}
+REUSED_LOCK = threading.Lock()
+# Journals of earlier snapshots, opened to check what can be reused
+PREVIOUS_JOURNALS = {}
+PREVIOUS_JOURNALS_LOCK = threading.Lock()
+
+
+def collect_metrics():
+    """The state of the run for metrics.Publisher"""
+    running, pending = scheduler.status()
+    transfers = downloader.in_flight()
+    counts = xunit.counts()
+
+    def per_transfer(value):
+        return [({'file': os.path.relpath(x.path, DOWNLOAD_ROOT)}, value(x)) for x in transfers]
+
+    return [
+        ('blastdb_run_start_time_seconds', 'gauge', 'When this run started',
+         [({'snapshot': DATESTAMP}, time.mktime(NOW.timetuple()))]),
+        ('blastdb_steps', 'gauge', 'Steps by status, as reported so far',
+         [({'status': status}, count) for (status, count) in sorted(counts.items())] +
+         [({'status': 'running'}, len(running)), ({'status': 'pending'}, pending)]),
+        ('blastdb_step_running_seconds', 'gauge', 'How long each running step has been going',
+         [({'classname': task.classname, 'step': task.testname}, seconds) for (task, seconds) in running]),
+        ('blastdb_downloaded_bytes_total', 'counter', 'Bytes downloaded so far, including those in flight',
+         [({}, downloader.completed_bytes + sum(x.bytes for x in transfers))]),
+        ('blastdb_transfer_bytes', 'gauge', 'Bytes of each file in flight on disk so far',
+         per_transfer(lambda x: x.done)),
+        ('blastdb_transfer_size_bytes', 'gauge', 'Size of each file in flight, where known',
+         per_transfer(lambda x: x.size)),
+        ('blastdb_transfer_rate_bytes_per_second', 'gauge', 'Recent download rate of each file in flight',
+         per_transfer(lambda x: x.rate)),
+        ('blastdb_transfer_eta_seconds', 'gauge', 'Estimated time left for each file in flight',
+         per_transfer(lambda x: x.eta)),
+    ]
+
+
+def write_manifest(classname, index_file, family, manifest):
+    """Record the ``family`` volumes in the ``index_file`` listing of
+    NCBI_BLAST_DB_URL, with their sizes and times, in ``manifest``."""
+    def func():
+        testname = 'manifest'
+        if journal.completed(classname, testname, manifest):
+            xunit.skip(classname, testname)
+            return True
+
+        with Timer() as t:
+            with open(index_file, 'r') as handle:
+                listing = parse_listing(handle.read())
+            names = set(x['name'] for x in listing)
+            volume = re.compile(r'^%s\.\d+\.tar\.gz$' % re.escape(family))
+            volumes = []
+            for entry in listing:
+                if volume.match(entry['name']):
+                    entry['url'] = NCBI_BLAST_DB_URL + entry['name']
+                    entry['md5_url'] = entry['url'] + '.md5' if entry['name'] + '.md5' in names else None
+                    volumes.append(entry)
+            volumes.sort(key=lambda x: (-x['size'], x['name']))
+
+        if not volumes:
+            xunit.failure(classname, testname, 'Download and Parsing Failed',
+                          errorDetails='No %s volumes in %s' % (family, index_file), time=t.interval)
+            return False
+        with open(partial(manifest), 'w') as handle:
+            json.dump({
+                'source': NCBI_BLAST_DB_URL,
+                'listed': NOW.isoformat(),
+                'volumes': volumes,
+            }, handle, indent=2, sort_keys=True)
+        os.rename(partial(manifest), manifest)
+        journal.commit(classname, testname, manifest, inputs=[index_file], duration=t.interval)
+        xunit.ok(classname, testname, time=t.interval, properties={
+            'volumes': len(volumes),
+            'total_size': sum(x['size'] for x in volumes),
+        })
+        return True
+    return func
+
+
+def read_manifest(directory):
+    """The volumes in a snapshot's manifest.json, by name, or None if it
+    has none (e.g. it predates them)"""
+    path = os.path.join(directory, 'manifest.json')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as handle:
+        return dict((x['name'], x) for x in json.load(handle)['volumes'])
+
+
+def download_properties(result):
+    properties = {
+        'bytes': result.bytes,
+        'bytes_per_second': '%.0f' % result.throughput,
+    }
+    for name, value in result.digests.items():
+        properties[name] = value
+    return properties
+
+
+def report_download(classname, testname, result):
+    if result.skipped:
+        xunit.skip(classname, testname)
+        return True
+
+    properties = download_properties(result)
+    if result.ok:
+        journal.commit(classname, testname, result.path, duration=result.interval,
+                       checksums=result.digests)
+        xunit.ok(classname, testname, time=result.interval, properties=properties)
+    elif isinstance(result.error, ChecksumError):
+        discard_published_md5(result.path)
+        xunit.failure(classname, testname, 'Checksum mismatch',
+                      errorDetails=str(result.error), time=result.interval,
+                      properties=properties)
+    else:
+        xunit.failure(classname, testname, 'Tarball Download Failed',
+                      errorDetails=str(result.error), time=result.interval,
+                      properties=properties)
+    return result.ok
+
+
+def read_md5(path):
+    """Checksum from an ``md5sum`` style file, or None"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as handle:
+        fields = handle.read().split()
+    if not fields:
+        return None
+    return fields[0]
+
+
+def published_md5(url, directory, listed=None):
+    """Find the published MD5 of ``url``.
+
+    NCBI and some EBI directories carry a ``.md5`` companion per file,
+    while UniProt lists them all in a RELEASE.metalink. Whichever was found
+    is kept in ``directory``. Given ``listed``, the manifest entry for
+    ``url``, only the ``md5_url`` it records is tried, if there is one.
+    """
+    basename = os.path.basename(url)
+    md5_file = os.path.join(directory, basename + '.md5')
+    if listed is not None:
+        if not listed.get('md5_url'):
+            return None
+        if downloader.fetch(listed['md5_url'], md5_file).ok:
+            return read_md5(md5_file)
+        log.warning('No published checksum for %s at %s', url, listed['md5_url'])
+        return None
+
+    if downloader.fetch(url + '.md5', md5_file).ok:
+        return read_md5(md5_file)
+
+    metalink = os.path.join(directory, 'RELEASE.metalink')
+    if not downloader.fetch(url[:-len(basename)] + 'RELEASE.metalink', metalink).ok:
+        log.warning('No published checksum for %s', url)
+        return None
+    for element in ElementTree.parse(metalink).iter():
+        if element.tag.endswith('}file') and element.get('name') == basename:
+            for child in element.iter():
+                if child.tag.endswith('}hash') and child.get('type') == 'md5':
+                    return child.text.strip()
+    log.warning('No published checksum for %s', url)
+    return None
+
+
+def discard_published_md5(path):
+    """Remove the checksums published_md5 kept for ``path``, so that they
+    are fetched again next time, in case it was a stale one that failed."""
+    discard(path + '.md5')
+    discard(os.path.join(os.path.dirname(path), 'RELEASE.metalink'))
+
+
+def which(program):
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        candidate = os.path.join(path, program)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+def blastdb_files(out):
+    """The files makeblastdb and blastdb_aliastool have written for
+    ``out``, including those of any numbered volumes or shards"""
+    own = re.compile(re.escape(os.path.basename(out)) + r'(\.\d+)*\.[pn][a-z]{2}$')
+    return sorted(x for x in glob.glob(out + '.*') if own.match(os.path.basename(x)))
+
+
+def remove_partial_build(out):
+    """Remove whatever an interrupted makeblastdb left behind for ``out``,
+    leaving the input, checksums and anything else alongside it alone"""
+    for path in blastdb_files(out):
+        log.info('Removing partial build output %s', path)
+        os.unlink(path)
+
+
+class ShardedBuild(object):
+    """Build the FASTA read from ``handle`` as shards ``<out>.00``,
+    ``<out>.01``..., joined by an alias ``<out>``.
+
+    The input is cut at record boundaries into blocks which are dealt out
+    to ``jobs`` makeblastdb processes in turn, so that they all build at
+    once even though the input arrives as one stream. A shard is finished
+    once it has been given ``size`` bytes, and a new one started in its
+    place. Reading happens on a thread of its own; ``wait`` collects the
+    outcome.
+    """
+    BLOCK_SIZE = 1024 * 1024
+    # Blocks queued for each shard, to smooth out the differing paces
+    QUEUE_SIZE = 8
+
+    def __init__(self, handle, out, title, dbtype='prot', size=None, jobs=None):
+        self.handle = handle
+        self.out = out
+        self.title = title
+        self.dbtype = dbtype
+        self.size = size or SHARD_SIZE
+        self.jobs = jobs or SHARD_JOBS
+        self.shards = []
+        self.error = None
+        self.thread = threading.Thread(target=self.__split)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __start_shard(self):
+        name = '%s.%02d' % (self.out, len(self.shards))
+        command = [
+            'makeblastdb',
+            '-in', '-',
+            '-dbtype', self.dbtype,
+            '-title', '%s %s' % (self.title, len(self.shards)),
+            '-out', name
+        ]
+        log.info(' '.join(command))
+        shard = {
+            'name': name,
+            'process': subprocess.Popen(command, stdin=subprocess.PIPE, cwd=DOWNLOAD_ROOT),
+            'queue': Queue(self.QUEUE_SIZE),
+            'written': 0,
+        }
+        shard['thread'] = threading.Thread(target=self.__feed, args=(shard,))
+        shard['thread'].daemon = True
+        shard['thread'].start()
+        self.shards.append(shard)
+        return shard
+
+    def __feed(self, shard):
+        process = shard['process']
+        while True:
+            block = shard['queue'].get()
+            if block is None:
+                break
+            try:
+                process.stdin.write(block)
+            except (IOError, OSError):
+                # makeblastdb gave up, keep draining so the splitter does
+                # not block. Its exit status tells what happened.
+                pass
+        try:
+            process.stdin.close()
+        except (IOError, OSError):
+            pass
+        shard['code'], shard['usage'] = wait_accounted(process)
+
+    def __split(self):
+        slots = [None] * self.jobs
+        turn = 0
+        pending = b''
+        try:
+            while True:
+                chunk = self.handle.read(self.BLOCK_SIZE)
+                pending += chunk
+                if chunk:
+                    # Only ever cut just before a '>' starting a line
+                    cut = pending.rfind(b'\n>') + 1
+                    if len(pending) < self.BLOCK_SIZE or cut == 0:
+                        continue
+                    block, pending = pending[:cut], pending[cut:]
+                else:
+                    block, pending = pending, b''
+                if block:
+                    shard = slots[turn]
+                    if shard is None or shard['written'] >= self.size:
+                        if shard is not None:
+                            shard['queue'].put(None)
+                            slots[turn] = None
+                        shard = slots[turn] = self.__start_shard()
+                    shard['queue'].put(block)
+                    shard['written'] += len(block)
+                    turn = (turn + 1) % self.jobs
+                if not chunk:
+                    break
+        except Exception as e:
+            # Reported by wait(). Stop reading, so that whatever writes to
+            # the handle gets a broken pipe rather than blocking.
+            self.error = e
+            try:
+                self.handle.close()
+            except (IOError, OSError):
+                pass
+        finally:
+            # The shards always get to finish, or wait() would never return
+            for shard in slots:
+                if shard is not None:
+                    shard['queue'].put(None)
+
+    def wait(self):
+        """Wait for every shard, then write the alias. Returns
+        ``(returncode, usage)``, the first non-zero exit status among them
+        if any, and the usage of all of them together. Raises whatever
+        stopped the input being read or a shard being started."""
+        self.thread.join()
+        for shard in self.shards:
+            shard['thread'].join()
+        if self.error is not None:
+            raise self.error
+        usages = [x['usage'] for x in self.shards]
+        failed = [x['code'] for x in self.shards if x['code']]
+        if failed or not self.shards:
+            return (failed[0] if failed else 1), combine_usage(usages)
+
+        directory = os.path.dirname(os.path.join(DOWNLOAD_ROOT, self.out))
+        command = [
+            'blastdb_aliastool',
+            '-dblist', ' '.join(os.path.basename(x['name']) for x in self.shards),
+            '-dbtype', self.dbtype,
+            '-title', self.title,
+            '-out', os.path.basename(self.out)
+        ]
+        log.info('cd %s && %s', directory, ' '.join(quote(x) for x in command))
+        code, usage = wait_accounted(subprocess.Popen(command, cwd=directory))
+        return code, combine_usage(usages + [usage])
+
+
+def sharded_build(classname, fasta_file, out, title):
+    """Build an already decompressed ``fasta_file`` with ShardedBuild"""
+    def func():
+        testname = 'build'
+        remove_partial_build(out)
+        with Timer() as t:
+            with open(fasta_file, 'rb') as handle:
+                code, usage = ShardedBuild(handle, out, title).wait()
+        outputs = blastdb_files(out)
+        if code != 0:
+            remove_partial_build(out)
+            xunit.failure(classname, testname, 'Makeblastdb failed', errorDetails='exited %s' % code,
+                          time=t.interval, properties=usage_properties(usage))
+            return False
+        journal.commit(classname, testname, out + '.pal', duration=t.interval, outputs=outputs,
+                       inputs=[fasta_file])
+        xunit.ok(classname, testname, time=t.interval, properties=usage_properties(usage, outputs))
+        if DELETE_INTERMEDIATES:
+            log.info('Removing built %s', fasta_file)
+            os.unlink(fasta_file)
+        return True
+    return func
+
+
+def stream_build(classname, url, gzip_file, out, title, sharded=False):
+    """Decompress ``gzip_file`` straight into makeblastdb, or a
+    ShardedBuild if ``sharded``.
+
+    If the file is not there yet it is downloaded, and the download is fed
+    to the decompressor as it arrives. The compressed file is kept so that a
+    failed build does not need to download it again.
+    """
+    def func():
+        testname = 'build'
+        remove_partial_build(out)
+
+        if which('pigz'):
+            decompress = ['pigz', '-dc', '-p', str(DECOMPRESS_THREADS)]
+        else:
+            decompress = ['gzip', '-dc']
+        makeblastdb = [
+            'makeblastdb',
+            '-in', '-',
+            '-dbtype', 'prot',
+            '-title', title,
+            '-out', out
+        ]
+        if sharded:
+            log.info('%s | %d makeblastdb shards', ' '.join(decompress), SHARD_JOBS)
+        else:
+            log.info('%s | %s', ' '.join(decompress), ' '.join(makeblastdb))
+
+        result = None
+        with Timer() as t:
+            if os.path.exists(gzip_file):
+                source = open(gzip_file, 'rb')
+            else:
+                source = subprocess.PIPE
+
+            decompressor = subprocess.Popen(decompress, stdin=source, stdout=subprocess.PIPE)
+            if sharded:
+                builder = ShardedBuild(decompressor.stdout, out, title)
+            else:
+                builder = subprocess.Popen(makeblastdb, stdin=decompressor.stdout, cwd=DOWNLOAD_ROOT)
+                # Only makeblastdb should hold the read end now, so that it
+                # exiting early gives the decompressor a broken pipe rather
+                # than a hang.
+                decompressor.stdout.close()
+
+            if source is subprocess.PIPE:
+                md5 = published_md5(url, os.path.dirname(gzip_file))
+                try:
+                    result = downloader.fetch(url, gzip_file, tee=decompressor.stdin,
+                                              expected={'md5': md5} if md5 else None,
+                                              digests=EXTRA_DIGESTS)
+                finally:
+                    try:
+                        decompressor.stdin.close()
+                    except (IOError, OSError):
+                        pass
+            else:
+                source.close()
+            decompressed, usage = wait_accounted(decompressor)
+            built, build_usage = builder.wait() if sharded else wait_accounted(builder)
+            codes = (decompressed, built)
+
+        outputs = blastdb_files(out)
+        properties = usage_properties(combine_usage([usage, build_usage]), outputs)
+        if result is not None:
+            properties.update(download_properties(result))
+
+        # A checksum mismatch only shows once the whole file has gone through
+        # makeblastdb, which will likely have been happy with it.
+        if result is not None and isinstance(result.error, ChecksumError):
+            discard_published_md5(gzip_file)
+            message, details = 'Checksum mismatch', str(result.error)
+        elif codes[1] != 0:
+            message, details = 'Makeblastdb failed', 'makeblastdb exited %s' % codes[1]
+        elif result is not None and not result.ok:
+            message, details = 'Download failed', str(result.error)
+        elif codes[0] != 0:
+            message, details = 'Extract failed', '%s exited %s' % (decompress[0], codes[0])
+        else:
+            journal.commit(classname, testname, out + '.pal', duration=t.interval, outputs=outputs,
+                           checksums=result.digests if result is not None else None)
+            xunit.ok(classname, testname, time=t.interval, properties=properties)
+            if DELETE_INTERMEDIATES and os.path.exists(gzip_file):
+                log.info('Removing built %s', gzip_file)
+                os.unlink(gzip_file)
+            return True
+
+        # makeblastdb may well have finished happily on truncated input, so
+        # throw its output away rather than have it mistaken for complete.
+        remove_partial_build(out)
+        xunit.failure(classname, testname, message, errorDetails=details,
+                      time=t.interval, properties=properties)
+        return False
+    return func
+
+
+def scaled(size, *factors):
+    """A space estimate from a remote size, or None if that is unknown"""
+    if size is None:
+        return None
+    for factor in factors:
+        size *= factor
+    return int(size)
 
 
 def uniref(db):
-    d = os.path.join(db, DATESTAMP)
+    d = snapshot_dir(db)
     fasta_file = os.path.join(d, db) + '.fasta'
     pal_file = os.path.join(d, db) + '.pal'
     classname = 'blast.uniref.%s' % db
     gzip_tmp_file = os.path.join(d, db) + '.fasta.gz'
 
-    # Exit early if the pal file exists. Otherwise the cleanup step removes a
-    # file that will get re-downloaded for zero use.
-    if os.path.exists(pal_file):
+    # Exit early if the build is complete. Otherwise the cleanup step removes
+    # a file that will get re-downloaded for zero use.
+    if journal.completed(classname, 'build', pal_file):
         xunit.skip(classname, 'COMPLETE')
         return
 
+    url = UNIREF_URL + '{db}/{db}.fasta.gz'.format(db=db)
+    size = downloader.remote_sizes([url])[url]
+    if STREAM_DECOMPRESS:
+        space = scaled(size, FASTA_EXPANSION, BLASTDB_EXPANSION)
+        if space is not None and not os.path.exists(gzip_tmp_file):
+            # Downloaded alongside the build
+            space += size
+        scheduler.call(classname, 'build', stream_build(classname, url, gzip_tmp_file, os.path.join(d, db), db,
+                                                        sharded=db in SHARDED),
+                       outputs=[pal_file], resource='cpu', space=space)
+        return
+
     # Download .fa
-    timedCommand(classname, 'download', 'Download failed', gzip_tmp_file, [
+    scheduler.command(classname, 'download', 'Download failed', gzip_tmp_file, [
         'wget', '--progress=dot:giga',
-        'ftp://ftp.ebi.ac.uk/pub/databases/uniprot/uniref/{db}/{db}.fasta.gz'.format(db=db),
+        url,
         '-O', gzip_tmp_file,
-    ])
+    ], resource='network', space=size)
 
-    timedCommand(classname, 'extract', 'Extract failed', fasta_file, [
+    scheduler.command(classname, 'extract', 'Extract failed', fasta_file, [
         'gzip', '-d',
         gzip_tmp_file,
-    ])
+    ], inputs=[gzip_tmp_file], resource='disk', space=scaled(size, FASTA_EXPANSION))
 
     # Makeblastdb
-    timedCommand(classname, 'build', 'Makeblastdb failed', pal_file, [
+    space = scaled(size, FASTA_EXPANSION, BLASTDB_EXPANSION)
+    if db in SHARDED:
+        scheduler.call(classname, 'build', sharded_build(classname, fasta_file, os.path.join(d, db), db),
+                       inputs=[fasta_file], outputs=[pal_file], resource='cpu', space=space)
+        return
+    scheduler.command(classname, 'build', 'Makeblastdb failed', pal_file, [
         'makeblastdb',
         '-in', fasta_file,
         '-dbtype', 'prot',
         '-out', os.path.join(d, db)
-    ])
+    ], inputs=[fasta_file], resource='cpu', space=space, blastdb=os.path.join(d, db))
+
+    if DELETE_INTERMEDIATES:
+        scheduler.call(classname, 'cleanup', remove_intermediate(classname, 'cleanup', fasta_file),
+                       inputs=[pal_file])
+
+
+def remove_intermediate(classname, testname, path):
+    """A task removing ``path`` once whatever was built from it is done"""
+    def func():
+        with Timer() as t:
+            try:
+                size = os.path.getsize(path) if os.path.exists(path) else 0
+                if size:
+                    os.remove(path)
+                error = None
+            except OSError as e:
+                error = e
+        if error is not None:
+            xunit.failure(classname, testname, 'Removing %s failed' % path, errorDetails=str(error),
+                          time=t.interval)
+            return False
+        xunit.ok(classname, testname, time=t.interval, properties={'bytes_freed': size})
+        return True
+    return func
+
+
+def queue_volumes(classname, directory, extension):
+    """Queue a download and an extraction task for each volume in the
+    snapshot's manifest, so that every volume is extracted as soon as it
+    lands rather than once the whole set has been downloaded.
+
+    The largest volumes go first, whichever database they belong to, so
+    that the run is not left waiting on one big download at the end.
+    """
+    try:
+        volumes = read_manifest(directory)
+        if volumes is None:
+            raise IOError('No manifest.json in %s' % directory)
+    except (IOError, OSError, ValueError, KeyError) as e:
+        xunit.failure(classname, 'queue', 'Reading the manifest failed', errorDetails=str(e))
+        return False
+    for volume in volumes.values():
+        url, size = volume['url'], volume['size']
+        basename = os.path.basename(url)
+        tarball = os.path.join(directory, basename)
+        shouldExist = tarball.replace('.tar.gz', extension)
+        scheduler.call(classname, 'download.%s' % basename,
+                       fetch_volume(classname, url, tarball, shouldExist, listed=volume),
+                       outputs=[tarball], resource='network', space=size, priority=size)
+        scheduler.call(classname, 'tar.extract.%s' % basename,
+                       extract_volume(classname, tarball, shouldExist),
+                       inputs=[tarball], resource='disk', space=scaled(size, TARBALL_EXPANSION), priority=size)
+    xunit.ok(classname, 'queue', properties={
+        'volumes': len(volumes),
+        'total_size': sum(x['size'] for x in volumes.values()),
+    })
+    return True
+
+
+def previous_snapshot(directory):
+    """The most recent snapshot of the same database before ``directory``"""
+    parent, current = os.path.split(os.path.normpath(directory))
+    earlier = [
+        x for x in os.listdir(parent or '.')
+        if x < current and os.path.isdir(os.path.join(parent, x))
+    ]
+    if not earlier:
+        return None
+    return os.path.join(parent, max(earlier))
+
+
+def link(src, dst):
+    """Hardlink ``src`` to ``dst``, falling back to a reflink (or plain
+    copy) if they are on different filesystems."""
+    if os.path.exists(dst):
+        return
+    try:
+        os.link(src, dst)
+    except OSError:
+        subprocess.check_call(['cp', '--reflink=auto', src, dst])
+
+
+def snapshot_journal(directory):
+    """The journal of the run that made the snapshot in ``directory``, or
+    None if there is none"""
+    path = os.path.join(DOWNLOAD_ROOT, 'journal-%s.sqlite' % os.path.basename(os.path.normpath(directory)))
+    if os.path.normpath(path) == os.path.normpath(JOURNAL):
+        return journal
+    with PREVIOUS_JOURNALS_LOCK:
+        if path not in PREVIOUS_JOURNALS:
+            PREVIOUS_JOURNALS[path] = Journal(path) if os.path.exists(path) else None
+        return PREVIOUS_JOURNALS[path]
+
+
+def reuse_volume(classname, tarball, shouldExist, previous):
+    """Link an unchanged volume in from the ``previous`` snapshot.
+
+    Returns the number of bytes that no longer need downloading, or None if
+    the volume changed (or cannot be reused). Only what the previous run's
+    journal records as complete is reused, so a volume whose download or
+    extraction was interrupted is not carried forward. Expects this
+    snapshot's .md5 to have been fetched already.
+    """
+    earlier = snapshot_journal(previous)
+    if earlier is None:
+        return None
+    basename = os.path.basename(tarball)
+    old_tarball = os.path.join(previous, basename)
+    old_md5 = old_tarball + '.md5'
+    new_md5 = tarball + '.md5'
+
+    listed = (read_manifest(os.path.dirname(tarball)) or {}).get(basename)
+    if os.path.exists(new_md5) and os.path.exists(old_md5):
+        with open(old_md5, 'r') as a, open(new_md5, 'r') as b:
+            unchanged = a.read().split()[:1] == b.read().split()[:1]
+    elif listed is None:
+        return None
+    else:
+        # No checksum to go on, so settle for the listing showing the same
+        # size, and time if the previous snapshot recorded it
+        before = (read_manifest(previous) or {}).get(basename)
+        if before is not None:
+            unchanged = (before['size'], before['mtime']) == (listed['size'], listed['mtime'])
+        elif os.path.exists(old_tarball):
+            unchanged = listed['size'] == os.path.getsize(old_tarball)
+        else:
+            return None
+    if not unchanged:
+        return None
+
+    # Prefer the extracted files, which saves the extraction as well.
+    contents = old_tarball + '.contents'
+    extracted = earlier.completed(classname, 'tar.extract.%s' % basename,
+                                  os.path.join(previous, os.path.basename(shouldExist)))
+    if extracted and os.path.exists(contents):
+        with open(contents, 'r') as handle:
+            members = [line.strip() for line in handle if line.strip()]
+        if all(os.path.exists(os.path.join(previous, x)) for x in members):
+            for member in members:
+                link(os.path.join(previous, member), os.path.join(os.path.dirname(tarball), member))
+            link(contents, tarball + '.contents')
+            if os.path.exists(old_tarball):
+                link(old_tarball, tarball)
+                return os.path.getsize(old_tarball)
+            return listed['size'] if listed is not None else 0
+
+    if earlier.completed(classname, 'download.%s' % basename, old_tarball):
+        link(old_tarball, tarball)
+        return os.path.getsize(old_tarball)
+    return None
+
+
+def fetch_volume(classname, url, tarball, shouldExist, listed=None):
+    def func():
+        testname = 'download.%s' % os.path.basename(tarball)
+        extract_testname = 'tar.extract.%s' % os.path.basename(tarball)
+        # The tarball may already have been extracted and removed
+        if journal.completed(classname, extract_testname, shouldExist):
+            xunit.skip(classname, testname)
+            return True
+
+        # Kept even for volumes that are downloaded, as it is also what the
+        # next snapshot compares against.
+        md5 = published_md5(url, os.path.dirname(tarball), listed=listed)
+        previous = None
+        if INCREMENTAL:
+            previous = previous_snapshot(os.path.dirname(tarball))
+
+        if previous is not None:
+            with Timer() as t:
+                avoided = reuse_volume(classname, tarball, shouldExist, previous)
+            if avoided is not None:
+                if os.path.exists(tarball):
+                    journal.commit(classname, testname, tarball)
+                if os.path.exists(shouldExist):
+                    # Linked in already extracted
+                    journal.commit(classname, extract_testname, shouldExist)
+                with REUSED_LOCK:
+                    stats = REUSED.setdefault(classname, {'volumes': 0, 'bytes_avoided': 0})
+                    stats['volumes'] += 1
+                    stats['bytes_avoided'] += avoided
+                xunit.ok(classname, testname, time=t.interval, properties={
+                    'reused_from': previous,
+                    'bytes_avoided': avoided,
+                })
+                return True
+
+        expected = {'md5': md5} if md5 else None
+        return report_download(classname, testname, downloader.fetch(
+            url, tarball, expected=expected, digests=EXTRA_DIGESTS))
+    return func
+
+
+def report_reuse():
+    for classname, stats in sorted(REUSED.items()):
+        xunit.ok(classname, 'incremental', properties=stats)
+
+
+def describe_snapshot(database, date):
+    """Catalog entries for the BLAST databases in one snapshot directory,
+    one for each of prot and nucl that it contains."""
+    path = os.path.join(database, date)
+    sizes = {}
+    for name in os.listdir(os.path.join(DOWNLOAD_ROOT, path)):
+        full = os.path.join(DOWNLOAD_ROOT, path, name)
+        if os.path.isfile(full):
+            sizes[name] = os.path.getsize(full)
+
+    entries = []
+    for dbtype, extension in (('prot', '.pin'), ('nucl', '.nin')):
+        volumes = []
+        for index in sorted(x for x in sizes if x.endswith(extension)):
+            volume = index[:-len(extension)]
+            volumes.append({
+                'name': volume,
+                'size': sum(size for (name, size) in sizes.items() if name.startswith(volume + '.')),
+            })
+        if volumes:
+            entries.append({
+                'database': database,
+                'date': date,
+                'type': dbtype,
+                'path': path,
+                'volumes': volumes,
+                'size': sum(x['size'] for x in volumes),
+            })
+            if 'manifest.json' in sizes:
+                # What the volumes were built from, as listed upstream
+                entries[-1]['manifest'] = os.path.join(path, 'manifest.json')
+    if not entries:
+        # Still being built, or never completed
+        entries.append({'database': database, 'date': date, 'type': None, 'path': path,
+                        'volumes': [], 'size': 0})
+    return entries
+
+
+def write_catalog():
+    """Bring CATALOG up to date with the snapshot directories on disk.
+
+    Snapshots already in the catalog are not described again, except for
+    this week's, so only new directories are listed in full.
+    """
+    catalog = []
+    if os.path.exists(CATALOG):
+        with open(CATALOG, 'r') as handle:
+            catalog = json.load(handle)
+    known = {}
+    for entry in catalog:
+        known.setdefault((entry['database'], entry['date']), []).append(entry)
+
+    updated = []
+    for database in sorted(os.listdir(DOWNLOAD_ROOT)):
+        if not os.path.isdir(os.path.join(DOWNLOAD_ROOT, database)):
+            continue
+        for date in sorted(os.listdir(os.path.join(DOWNLOAD_ROOT, database))):
+            if not SNAPSHOT_DIR.match(date) or not os.path.isdir(os.path.join(DOWNLOAD_ROOT, database, date)):
+                continue
+            if (database, date) in known and date != DATESTAMP:
+                updated.extend(known[(database, date)])
+            else:
+                updated.extend(describe_snapshot(database, date))
+
+    with open(CATALOG + '.part', 'w') as handle:
+        json.dump(updated, handle, indent=2, sort_keys=True)
+    os.rename(CATALOG + '.part', CATALOG)
+
+
+def extract_volume(classname, tarball, shouldExist):
+    def func():
+        basename = os.path.basename(tarball)
+        # The member list lets next week's snapshot link these files in
+        # if the volume has not changed.
+        success = timedCommand(classname, 'tar.extract.%s' % basename, 'Extraction failed', shouldExist, [
+            'tar',
+            '-xvf',
+            basename,
+            '>', basename + '.contents'
+        ], shell=True, cwd=os.path.dirname(tarball))
+
+        if success and DELETE_INTERMEDIATES and os.path.exists(shouldExist) and os.path.exists(tarball):
+            log.info('Removing extracted %s', tarball)
+            os.unlink(tarball)
+        return success
+    return func
+
+
+def ncbi_volumes(family, extension):
+    classname = 'ncbi.%s' % family
+    directory = snapshot_dir(family)
+    manifest = os.path.join(directory, 'manifest.json')
+    scheduler.call(classname, 'manifest', write_manifest(classname, 'ncbi_index', family, manifest),
+                   inputs=['ncbi_index'], outputs=[manifest])
+    scheduler.call(classname, 'queue', lambda: queue_volumes(classname, directory, extension),
+                   inputs=[manifest])
 
 
 def ncbi():
-    timedCommand('ncbi.index', 'download', 'Download failed', 'ncbi_index', [
+    scheduler.command('ncbi.index', 'download', 'Download failed', 'ncbi_index', [
         'curl',
         '--silent',
-        'ftp://ftp.ncbi.nih.gov/blast/db/',
+        NCBI_BLAST_DB_URL,
         '-o',
         'ncbi_index'
-    ])
-
-    nt_dir = os.path.join('nt', DATESTAMP)
-    nt_urls = os.path.join(nt_dir, 'nt.urls')
-    nr_dir = os.path.join('nr', DATESTAMP)
-    nr_urls = os.path.join(nr_dir, 'nr.urls')
-
-    timedCommand('ncbi.nt', 'urls', 'Download and Parsing Failed', nt_urls, [
-        'cat', 'ncbi_index',
-        '|',
-        'grep', '-o', quote(' nt\..*gz'),
-        '|',
-        'sed', quote('s| |ftp://ftp.ncbi.nih.gov/blast/db/|g'),
-        '>',
-        nt_urls
-    ], shell=True)
+    ], resource='network')
 
-    timedCommand('ncbi.nt', 'download', 'Tarball Download Failed', os.path.join(nt_dir, 'nt.00.tar.gz'), [
-        'wget', '--progress=dot:giga',
-        '--no-clobber',
-        '--continue',
-        '--input-file=nt.urls',
-    ], cwd=nt_dir)
-
-    for tarball in sorted(glob.glob(os.path.join(nt_dir, '*.tar.gz'))):
-        basename = os.path.basename(tarball)
-        shouldExist = tarball.replace('.tar.gz', '.nin')
-        timedCommand('ncbi.nt', 'tar.extract.%s' % basename, 'Extraction failed', shouldExist, [
-            'tar',
-            '-xvf',
-            basename
-        ], cwd=nt_dir)
-
-
-    timedCommand('ncbi.nr', 'urls', 'Download failed', nr_urls, [
-        'cat', 'ncbi_index',
-        '|',
-        'grep', '-o', quote(' nr\..*gz'),
-        '|',
-        'sed', quote('s| |ftp://ftp.ncbi.nih.gov/blast/db/|g'),
-        '>',
-        nr_urls
-    ], shell=True)
+    ncbi_volumes('nt', '.nin')
+    ncbi_volumes('nr', '.pin')
 
-    timedCommand('ncbi.nr', 'download', 'Tarball Download Failed', os.path.join(nr_dir, 'nr.00.tar.gz'), [
-        'wget', '--progress=dot:giga',
-        '--no-clobber',
-        '--continue',
-        '--input-file=nr.urls',
-    ], cwd=nr_dir)
 
-    for tarball in sorted(glob.glob(os.path.join(nr_dir, '*.tar.gz'))):
-        basename = os.path.basename(tarball)
-        shouldExist = tarball.replace('.tar.gz', '.pin')
-        timedCommand('ncbi.nr', 'tar.extract.%s' % basename, 'Extraction failed', shouldExist, [
-            'tar',
-            '-xvf',
-            basename
-        ], cwd=nr_dir)
+def efetch_records(ids, rettype):
+    """Yield ``(batch, cached, text)`` for the records of ``ids``, taking
+    ``cached`` of each batch from the record cache where there is one."""
+    if record_cache is None:
+        for batch, text in eutils.efetch(ids, rettype=rettype):
+            yield batch, 0, text
+        return
+    for result in record_cache.efetch(eutils, eutils.versions(ids), rettype=rettype):
+        yield result
 
 
 def representative():
-    rep_dir = os.path.join('representative', DATESTAMP)
-    if not os.path.exists(rep_dir):
-        os.makedirs(rep_dir)
+    rep_dir = snapshot_dir('representative')
 
     urls_tsv = os.path.join(rep_dir, 'urls.tsv')
     classname = 'ncbi.representative_bacteria'
-    timedCommand(classname, 'urls.tsv', 'Download URLs', urls_tsv, [
+    scheduler.command(classname, 'urls.tsv', 'Download URLs', urls_tsv, [
         'wget', '--progress=dot:giga',
-        quote('http://www.ncbi.nlm.nih.gov/genomes/Genome2BE/genome2srv.cgi?action=refgenomes&download=on&type=reference'),
+        quote(REFERENCE_GENOMES_URL),
         '-O',
         urls_tsv
-    ], shell=True)
+    ], shell=True, resource='network')
 
     gis_list = os.path.join(rep_dir, 'gis.list')
-    timedCommand(classname, 'gis.list', 'Generate GI List', gis_list, [
+    scheduler.command(classname, 'gis.list', 'Generate GI List', gis_list, [
         'awk', '-F"\\t"', '\'(NR>1){print $4}\'',
         '<', urls_tsv,
         '|',
@@ -244,66 +1411,146 @@ def representative():
         'sort', '-u',
         '>',
         gis_list
-    ], shell=True)
-
-    efetch_urls = os.path.join(rep_dir, 'efetch.urls')
-    timedCommand(classname, 'efetch.urls', 'Generate EFetch URLs', efetch_urls, [
-        'sed', quote('s|^|https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=nuccore\&rettype=gbwithparts\&retmode=text\&id=|g'),
-        '<', gis_list,
-        '>', efetch_urls
-    ], shell=True)
+    ], shell=True, inputs=[urls_tsv])
 
     merged_fa = os.path.join(rep_dir, 'merged.fa')
-
-    tmpfile = subprocess.check_output(['mktemp']).strip()
-
-    if not os.path.exists(merged_fa):
-        with open(efetch_urls, 'r') as handle:
-            for line in handle:
-                # URL from file
-                url = line.strip()
-                # Get genome ID: This could remove the step above but ...meh
-                gid = url[url.rindex('=') + 1:]
-
-                # IF ONLY THEY PROVIDED AN E-TAG WE WOULDN'T HAVE TO FRIGGING DO THIS.
-                timedCommand(classname, 'wget.' + gid , 'Download ' + gid, 'does_not_exist', [
-                    'curl',
-                    '--silent',
-                    '"%s"' % url,
-                    '>>',
-                    tmpfile
-                ], shell=True)
-
-                # Sleep to not piss NCBI off since they're touchy about this stuff. Grumbles.
-                time.sleep(random.randint(1, 20))
-
-    timedCommand(classname, 'protein_export', 'Export CDS Features', merged_fa, [
-        'python',
-        os.path.join(SCRIPT_DIR, 'feature_export.py'),
-        '--strip_stops',
-        '--informative',
-        '--translate',
-        '--translation_table_id', '11',
-        tmpfile, 'CDS',
-        '>', merged_fa
-    ], shell=True)
-
-    timedCommand(classname, 'makeblastdb', 'Build BLAST Database', os.path.join(rep_dir, 'representative.pin'), [
+    genbank_file = os.path.join(rep_dir, 'genomes.gb')
+    outputs = [merged_fa, genbank_file] if KEEP_GENBANK else [merged_fa]
+
+    # The export's worker processes are forked now, while this is the only
+    # thread, rather than from a scheduler thread later on, which could
+    # copy a lock some other thread holds into them. As children of this
+    # process they are counted in RUSAGE_CHILDREN once the pool is joined.
+    pool = None
+    if not journal.completed(classname, 'protein_export', merged_fa):
+        # Only this pipeline needs Biopython, so only it imports it, and
+        # before forking so that the workers share it
+        import feature_export
+        import export_worker
+        pool = multiprocessing.Pool(EXPORT_JOBS)
+
+    def export_proteins():
+        testname = 'protein_export'
+        if journal.completed(classname, testname, merged_fa):
+            xunit.skip(classname, testname)
+            return True
+        if pool is None:
+            xunit.failure(classname, testname, 'Export CDS Features',
+                          errorDetails='%s was removed during the run' % merged_fa)
+            return False
+
+        with open(gis_list, 'r') as handle:
+            ids = [line.strip() for line in handle if line.strip()]
+
+        for path in outputs:
+            discard(path)
+        kwargs = {
+            'tag': 'CDS',
+            'translate': True,
+            'translation_table_id': 11,
+            'strip_stops': True,
+            'informative': True,
+        }
+        # Each batch is translated by the pool while the next is fetched.
+        # At most ``window`` shards are waiting to be written at a time.
+        window = EXPORT_JOBS * 2
+        pending = collections.deque()
+        # What the workers used for each shard
+        usages = []
+
+        def write_next():
+            fasta, usage = pending.popleft().get()
+            out.write(fasta)
+            usages.append(usage)
+        success = True
+        hits = 0
+        fetched = 0
+        try:
+            with Timer() as t:
+                with open(partial(merged_fa), 'w') as out:
+                    genbank = open(partial(genbank_file), 'w') if KEEP_GENBANK else None
+                    try:
+                        batches = efetch_records(ids, rettype='gbwithparts')
+                        for idx in itertools.count():
+                            batch_testname = 'efetch.%s' % idx
+                            with Timer() as bt:
+                                try:
+                                    batch, cached, text = next(batches)
+                                    error = None
+                                except StopIteration:
+                                    break
+                                except (IOError, OSError) as e:
+                                    error = e
+
+                            if error is not None:
+                                xunit.failure(classname, batch_testname, 'Download failed', errorDetails=str(error),
+                                              time=bt.interval)
+                                success = False
+                                break
+                            hits += cached
+                            fetched += len(batch)
+                            xunit.ok(classname, batch_testname, time=bt.interval, properties={
+                                'ids': len(batch),
+                                'first': batch[0],
+                                'last': batch[-1],
+                                'cached': cached,
+                                'bytes': len(text),
+                            })
+
+                            if genbank is not None:
+                                genbank.write(text)
+                            for shard in feature_export.split_records(StringIO(text)):
+                                pending.append(pool.apply_async(export_worker.export_shard, [(shard, kwargs)]))
+                                while pending and (len(pending) > window or pending[0].ready()):
+                                    write_next()
+                        while pending:
+                            write_next()
+                    finally:
+                        if genbank is not None:
+                            genbank.close()
+        except Exception as e:
+            xunit.failure(classname, testname, 'Export CDS Features', errorDetails=str(e), time=t.interval)
+            return False
+        finally:
+            pool.terminate()
+            pool.join()
+
+        if not success:
+            for path in outputs:
+                discard(path)
+            xunit.failure(classname, testname, 'Export CDS Features',
+                          errorDetails='Not every EFetch batch was downloaded', time=t.interval,
+                          properties={'cache_hits': hits})
+            return False
+        for path in outputs:
+            os.rename(partial(path), path)
+        journal.commit(classname, testname, merged_fa, inputs=[gis_list], duration=t.interval, outputs=outputs)
+        properties = usage_properties(combine_usage(usages), [merged_fa])
+        properties.update({
+            'genomes': len(ids),
+            'cache_hits': hits,
+            'cache_misses': fetched - hits,
+        })
+        xunit.ok(classname, testname, time=t.interval, properties=properties)
+        return True
+
+    scheduler.call(classname, 'protein_export', export_proteins, inputs=[gis_list],
+                   outputs=outputs, resource='network')
+
+    scheduler.command(classname, 'makeblastdb', 'Build BLAST Database', os.path.join(rep_dir, 'representative.pin'), [
         'makeblastdb',
         '-in', merged_fa,
         '-dbtype', 'prot',
         '-out', os.path.join(rep_dir, 'representative')
-    ])
-    subprocess.check_call(['rm', '-f', tmpfile])
+    ], inputs=[merged_fa], resource='cpu', blastdb=os.path.join(rep_dir, 'representative'))
 
 
 def canonical_phages():
-    rep_dir = os.path.join('canonical', DATESTAMP)
-    if not os.path.exists(rep_dir):
-        os.makedirs(rep_dir)
+    rep_dir = snapshot_dir('canonical')
 
     canonical_ids = []
-    with open(os.path.join(SCRIPT_DIR, 'canonical_phages.list'), 'r') as handle:
+    phage_list = os.path.join(SCRIPT_DIR, 'canonical_phages.list')
+    with open(phage_list, 'r') as handle:
         for line in handle:
             line = line.strip()
             (uid, name) = line.split('\t')
@@ -313,106 +1560,130 @@ def canonical_phages():
             name = re.sub('[^A-Za-z0-9_-]', '', name)
             canonical_ids.append((uid, name))
     classname = 'canonical_phage_db'
+    names = dict(canonical_ids)
+    # Whole IDs only, so that NC_001416.1 is not found inside NC_001416.11,
+    # and only in the header lines, never in sequence or feature text
+    accessions = re.compile(r'\b(?:%s)(?![\d.])' % '|'.join(
+        re.escape(x) for x in sorted(names, key=len, reverse=True)))
+    headers = re.compile(r'^(?:>|LOCUS |ACCESSION |VERSION ).*$', re.M)
+
+    def rename(text):
+        return headers.sub(lambda line: accessions.sub(lambda m: names[m.group(0)], line.group(0)), text)
+
+    def download(fmt, merged):
+        # Fetch every genome in batches, renaming accessions to the curated
+        # names as the records are written out.
+        def func():
+            testname = 'download.%s' % fmt
+            if journal.completed(classname, testname, merged):
+                xunit.skip(classname, testname)
+                return True
+
+            discard(merged)
+            hits = 0
+            fetched = 0
+            with Timer() as t:
+                try:
+                    with open(partial(merged), 'w') as handle:
+                        for batch, cached, text in efetch_records([uid for (uid, _) in canonical_ids], fmt):
+                            handle.write(rename(text))
+                            hits += cached
+                            fetched += len(batch)
+                    os.rename(partial(merged), merged)
+                    error = None
+                except (IOError, OSError) as e:
+                    error = e
+
+            properties = {'ids': len(names), 'cache_hits': hits}
+            if error is None:
+                journal.commit(classname, testname, merged, inputs=[phage_list], duration=t.interval)
+                properties['cache_misses'] = fetched - hits
+                xunit.ok(classname, testname, time=t.interval, properties=properties)
+                return True
+            discard(merged)
+            xunit.failure(classname, testname, 'Downloading %s Failed' % fmt, errorDetails=str(error),
+                          time=t.interval, properties=properties)
+            return False
+        return func
 
-    # Download individual genomes as fasta format (nucleotide)
-    for ncbi_id, ncbi_name in canonical_ids:
-        tmpout = os.path.join(rep_dir, ncbi_id + '.fa')
-        timedCommand(classname, 'download.%s' % ncbi_id, 'Downloading %s Failed' % ncbi_id, tmpout, [
-            os.path.join(SCRIPT_DIR, 'edirect', 'efetch'),
-            '-db', 'nuccore',
-            '-id', ncbi_id,
-            '-format', 'fasta'
-            '>', tmpout
-        ], shell=True)
-        time.sleep(random.randint(1, 20))
-
-        timedCommand(classname, 'sed.%s' % ncbi_id, 'Name Correction %s Failed' % ncbi_id, 'does-not-exist', [
-            'sed', '-i',
-            's/%s/%s/g' % (ncbi_id, ncbi_name),
-            tmpout
-        ], shell=True)
-
-        # And then download as protein fasta.
-        tmpout = os.path.join(rep_dir, ncbi_id + '.pfa')
-        timedCommand(classname, 'download.%s' % ncbi_id, 'Downloading %s Failed' % ncbi_id, tmpout, [
-            os.path.join(SCRIPT_DIR, 'edirect', 'efetch'),
-            '-db', 'nuccore',
-            '-id', ncbi_id,
-            '-format', 'fasta_cds_aa'
-            '>', tmpout
-        ], shell=True)
-
-        timedCommand(classname, 'sed.%s' % ncbi_id, 'Name Correction %s Failed' % ncbi_id, 'does-not-exist', [
-            'sed', '-i',
-            's/%s/%s/g' % (ncbi_id, ncbi_name),
-            tmpout
-        ], shell=True)
-        time.sleep(random.randint(1, 20))
-
-    # Concatenate all PFA + FA files to their respective merged versions
     merged_nucl = os.path.join(rep_dir, 'merged.fa')
     merged_prot = os.path.join(rep_dir, 'merged.pfa')
-
-    timedCommand(classname, 'merge.nucl', 'Merging Failed', merged_nucl, [
-        'cat', os.path.join(rep_dir, '*.fa'),
-        '>', merged_nucl
-    ], shell=True)
-
-    timedCommand(classname, 'merge.prot', 'Merging Failed', merged_prot, [
-        'cat', os.path.join(rep_dir, '*.pfa'),
-        '>', merged_prot
-    ], shell=True)
+    scheduler.call(classname, 'download.fasta', download('fasta', merged_nucl),
+                   outputs=[merged_nucl], resource='network')
+    scheduler.call(classname, 'download.fasta_cds_aa', download('fasta_cds_aa', merged_prot),
+                   outputs=[merged_prot], resource='network')
 
     # Now with both of those downloaded, build Prot + Nucl databases.
     db_name_prot = os.path.join(rep_dir, 'canonical_prot') # + .pin
     db_name_nucl = os.path.join(rep_dir, 'canonical_nucl') # + .nin
-    timedCommand(classname, 'makeblastdb', 'Build Nucleotide BLAST Database', db_name_nucl + '.nin', [
+    scheduler.command(classname, 'makeblastdb', 'Build Nucleotide BLAST Database', db_name_nucl + '.nin', [
         'makeblastdb',
         '-in', merged_nucl,
         '-dbtype', 'nucl',
         '-out', db_name_nucl,
-    ])
+    ], inputs=[merged_nucl], resource='cpu', blastdb=db_name_nucl)
 
-    timedCommand(classname, 'makeblastdb', 'Build Protein BLAST Database', db_name_prot + '.pin', [
+    scheduler.command(classname, 'makeblastdb', 'Build Protein BLAST Database', db_name_prot + '.pin', [
         'makeblastdb',
         '-in', merged_prot,
         '-dbtype', 'prot',
         '-out', db_name_prot,
-    ])
+    ], inputs=[merged_prot], resource='cpu', blastdb=db_name_prot)
 
 def uniprot(db):
     # db must be trembl or sprot
-    d = os.path.join(db, DATESTAMP)
+    d = snapshot_dir(db)
     fasta_file = os.path.join(d, db) + '.fasta'
     pal_file = os.path.join(d, db) + '.pal'
     classname = 'blast.uniprot.%s' % db
     gzip_tmp_file = os.path.join(d, db) + '.fasta.gz'
 
-    # Exit early if the pal file exists. Otherwise the cleanup step removes a
-    # file that will get re-downloaded for zero use.
-    if os.path.exists(pal_file):
+    # Exit early if the build is complete. Otherwise the cleanup step removes
+    # a file that will get re-downloaded for zero use.
+    if journal.completed(classname, 'build', pal_file):
         xunit.skip(classname, 'COMPLETE')
         return
 
+    url = UNIPROT_URL + 'uniprot_{db}.fasta.gz'.format(db=db)
+    size = downloader.remote_sizes([url])[url]
+    if STREAM_DECOMPRESS:
+        space = scaled(size, FASTA_EXPANSION, BLASTDB_EXPANSION)
+        if space is not None and not os.path.exists(gzip_tmp_file):
+            # Downloaded alongside the build
+            space += size
+        scheduler.call(classname, 'build', stream_build(classname, url, gzip_tmp_file, os.path.join(d, db), db,
+                                                        sharded=db in SHARDED),
+                       outputs=[pal_file], resource='cpu', space=space)
+        return
+
     # Download .fa
-    timedCommand(classname, 'download', 'Download failed', gzip_tmp_file, [
+    scheduler.command(classname, 'download', 'Download failed', gzip_tmp_file, [
         'wget', '--progress=dot:giga',
-        'ftp://ftp.uniprot.org/pub/databases/uniprot/current_release/knowledgebase/complete/uniprot_{db}.fasta.gz'.format(db=db),
+        url,
         '-O', gzip_tmp_file,
-    ])
+    ], resource='network', space=size)
 
-    timedCommand(classname, 'extract', 'Extract failed', fasta_file, [
+    scheduler.command(classname, 'extract', 'Extract failed', fasta_file, [
         'gzip', '-d',
         gzip_tmp_file,
-    ])
+    ], inputs=[gzip_tmp_file], resource='disk', space=scaled(size, FASTA_EXPANSION))
 
     # Makeblastdb
-    timedCommand(classname, 'build', 'Makeblastdb failed', pal_file, [
+    space = scaled(size, FASTA_EXPANSION, BLASTDB_EXPANSION)
+    if db in SHARDED:
+        scheduler.call(classname, 'build', sharded_build(classname, fasta_file, os.path.join(d, db), db),
+                       inputs=[fasta_file], outputs=[pal_file], resource='cpu', space=space)
+        return
+    scheduler.command(classname, 'build', 'Makeblastdb failed', pal_file, [
         'makeblastdb',
         '-in', fasta_file,
         '-dbtype', 'prot',
         '-out', os.path.join(d, db)
-    ])
+    ], inputs=[fasta_file], resource='cpu', space=space, blastdb=os.path.join(d, db))
+
+    if DELETE_INTERMEDIATES:
+        scheduler.call(classname, 'cleanup', remove_intermediate(classname, 'cleanup', fasta_file),
+                       inputs=[pal_file])
 
 if __name__ == '__main__':
     ## omitting uniref updates per Jason Gill
@@ -426,6 +1697,25 @@ if __name__ == '__main__':
     uniprot('sprot')
     uniprot('trembl')
 
+    publisher = None
+    if METRICS_FILE is not None or METRICS_PORT is not None:
+        publisher = Publisher(collect_metrics, path=METRICS_FILE, port=METRICS_PORT,
+                              interval=METRICS_INTERVAL).start()
+
+    # Independent pipelines now run side by side, limited by WORKERS and
+    # RESOURCE_LIMITS
+    success = scheduler.run()
+    report_reuse()
+    write_catalog()
+
     # Write out the report
     with open(sys.argv[1], 'w') as handle:
         handle.write(xunit.serialize())
+    # Alongside it, the same with each step's resource use as JSON
+    with open(sys.argv[1] + '.json', 'w') as handle:
+        handle.write(xunit.serialize_json())
+
+    if publisher is not None:
+        publisher.stop()
+
+    sys.exit(0 if success else 1)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""Minimal NCBI E-utilities client.
+
+IDs are POSTed in batches, requests are paced to NCBI's documented limits
+(3 requests/second, or 10 with an API key) and throttled or failed requests
+are retried with backoff.
+"""
+import json
+import time
+import socket
+import logging
+import threading
+
+try:  # py3
+    from urllib.request import Request, urlopen
+    from urllib.parse import urlencode
+    from urllib.error import HTTPError, URLError
+except ImportError:  # py2
+    from urllib2 import Request, urlopen, HTTPError, URLError
+    from urllib import urlencode
+
+log = logging.getLogger('dl.eutils')
+
+EUTILS_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+TIMEOUT = 300
+
+
+class TokenBucket(object):
+    """Allow ``rate`` acquisitions per second, with bursts of up to
+    ``capacity``. Safe to share between threads."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class EUtils(object):
+
+    def __init__(self, api_key=None, email=None, tool='blast-db-download',
+                 base_url=EUTILS_URL, batch_size=200, retries=5, backoff=2):
+        self.api_key = api_key
+        self.email = email
+        self.tool = tool
+        self.base_url = base_url
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.bucket = TokenBucket(10 if api_key else 3)
+
+    def request(self, endpoint, params):
+        """POST ``params`` to ``endpoint`` (e.g. ``efetch.fcgi``) and return
+        the response body as text."""
+        params = dict(params)
+        params['tool'] = self.tool
+        if self.email:
+            params['email'] = self.email
+        if self.api_key:
+            params['api_key'] = self.api_key
+        data = urlencode(params).encode('ascii')
+
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                response = urlopen(Request(self.base_url + endpoint, data=data), timeout=TIMEOUT)
+                try:
+                    body = response.read()
+                finally:
+                    response.close()
+                if not isinstance(body, str):
+                    body = body.decode('utf-8')
+                return body
+            except HTTPError as e:
+                if e.code != 429 and e.code < 500:
+                    raise
+                error = e
+                delay = e.headers.get('Retry-After') if e.headers else None
+            except (URLError, socket.error) as e:
+                error = e
+                delay = None
+
+            attempt += 1
+            if attempt > self.retries:
+                raise error
+            try:
+                delay = float(delay)
+            except (TypeError, ValueError):
+                delay = self.backoff ** attempt
+            log.warning('%s failed (%s), retry %s/%s in %ss', endpoint, error, attempt, self.retries, delay)
+            time.sleep(delay)
+
+    def batches(self, ids):
+        ids = list(ids)
+        for start in range(0, len(ids), self.batch_size):
+            yield ids[start:start + self.batch_size]
+
+    def efetch(self, ids, db='nuccore', rettype='gbwithparts', retmode='text'):
+        """Yield ``(batch, text)`` for every batch of ``ids``"""
+        for batch in self.batches(ids):
+            yield batch, self.request('efetch.fcgi', {
+                'db': db,
+                'id': ','.join(batch),
+                'rettype': rettype,
+                'retmode': retmode,
+            })
+
+    def versions(self, ids, db='nuccore'):
+        """Return the accession.version of each of ``ids``, in order.
+
+        IDs which already have a version are kept as they are. GIs and bare
+        accessions are looked up with ``rettype=acc``, which gives the
+        current version. Any that NCBI no longer knows (e.g. withdrawn GIs)
+        are logged and left out.
+        """
+        ids = list(ids)
+        unversioned = [x for x in ids if x.isdigit() or '.' not in x]
+        found = {}
+        for batch in self.batches(unversioned):
+            found.update(self.__versions(batch, db))
+        missing = [x for x in unversioned if x not in found]
+        if missing:
+            log.warning('No accession.version for %s IDs, skipping them: %s', len(missing), ', '.join(missing))
+        missing = set(missing)
+        return [found.get(x, x) for x in ids if x not in missing]
+
+    def __versions(self, batch, db):
+        # rettype=acc leaves out IDs it does not know, so when the answer is
+        # short there is no telling which line is which. Halve the batch
+        # until each part pairs up, down to the single IDs that are missing.
+        try:
+            text = self.request('efetch.fcgi', {
+                'db': db,
+                'id': ','.join(batch),
+                'rettype': 'acc',
+                'retmode': 'text',
+            })
+            versions = [line.strip() for line in text.splitlines() if line.strip()]
+        except HTTPError as e:
+            if e.code == 429 or e.code >= 500:
+                raise
+            # NCBI rejects some requests outright for a bad ID
+            versions = []
+        if len(versions) == len(batch) and all(
+                x.isdigit() or v.rsplit('.', 1)[0] == x for (x, v) in zip(batch, versions)):
+            return dict(zip(batch, versions))
+        if len(batch) == 1:
+            return {}
+        middle = len(batch) // 2
+        found = self.__versions(batch[:middle], db)
+        found.update(self.__versions(batch[middle:], db))
+        return found
+
+    def esearch(self, term, db='nuccore', idtype=None, page=10000):
+        """Return every ID matching ``term``, fetching ``page`` at a time.
+        With ``idtype='acc'`` these are accession.version strings rather
+        than UIDs."""
+        ids = []
+        while True:
+            params = {
+                'db': db,
+                'term': term,
+                'retstart': len(ids),
+                'retmax': page,
+                'retmode': 'json',
+            }
+            if idtype:
+                params['idtype'] = idtype
+            result = json.loads(self.request('esearch.fcgi', params))['esearchresult']
+            ids.extend(result['idlist'])
+            if not result['idlist'] or len(ids) >= int(result['count']):
+                return ids
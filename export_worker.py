@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""Entry point of download.py's protein export workers.
+
+A worker only needs this module and feature_export, so nothing else has to
+be set up for it. Each shard comes back with what exporting it cost the
+worker, which the parent cannot measure for processes still running in a
+pool.
+"""
+import resource
+
+import feature_export
+
+
+def io_counters():
+    """``(bytes_read, bytes_written)`` of this process, or None"""
+    try:
+        with open('/proc/self/io', 'r') as handle:
+            io = dict(line.split(': ') for line in handle.read().splitlines())
+        return int(io['rchar']), int(io['wchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+
+def export_shard(args):
+    """Return the FASTA of ``feature_export._export_shard(args)`` and its
+    usage, in the form of download.py's ``wait_accounted``"""
+    io_before = io_counters()
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    fasta = feature_export._export_shard(args)
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    io_after = io_counters()
+
+    usage = {
+        'cpu_user': after.ru_utime - before.ru_utime,
+        'cpu_system': after.ru_stime - before.ru_stime,
+        # Kilobytes on Linux
+        'max_rss': after.ru_maxrss * 1024,
+    }
+    if io_before is not None and io_after is not None:
+        usage['bytes_read'] = io_after[0] - io_before[0]
+        usage['bytes_written'] = io_after[1] - io_before[1]
+    return fasta, usage
@@ -1,17 +1,49 @@
 #!/usr/bin/env python
 import sys
-import json
+import argparse
 from tqdm import tqdm
-from Bio import SeqIO
+from genbank import scan
+from phagedb import WRITERS, resume_point, summary
 
 
-data = []
-for rec in tqdm(SeqIO.parse(sys.stdin, 'genbank')):
-    data.append({
-        'id': rec.id,
-        'desc': rec.description,
-        'name': rec.name,
-        'source': rec.annotations.get('source', None)
-    })
+def main(args):
+    writer_class = WRITERS[args.format]
+    records = scan(sys.stdin, sequence=False)
 
-json.dump(data, sys.stdout, indent=2)
+    if args.output is None:
+        writer = writer_class(sys.stdout)
+    else:
+        offset, count = 0, 0
+        if args.resume:
+            offset, count, last_id = resume_point(args.output, args.format)
+        if count:
+            # Skip what was already written, checking that it came from the
+            # same input
+            for (i, rec) in enumerate(records):
+                if i + 1 == count:
+                    if rec.id != last_id:
+                        sys.exit('%s ends with %s but entry %s of the input is %s, not resuming' % (
+                            args.output, last_id, count, rec.id))
+                    break
+            else:
+                sys.exit('%s has more entries than the input, not resuming' % args.output)
+            sys.stderr.write('Resuming after %s entries\n' % count)
+        with open(args.output, 'ab') as handle:
+            handle.truncate(offset)
+        writer = writer_class(open(args.output, 'a'), count=count)
+
+    # Only the header is needed, features and sequence are skipped unparsed
+    for rec in tqdm(records):
+        writer.write(summary(rec))
+    writer.close()
+    writer.handle.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarise GenBank records from stdin as JSON')
+    parser.add_argument('--format', choices=sorted(WRITERS), default='json',
+                        help='A JSON array (as db.json) or JSON Lines')
+    parser.add_argument('--output', help='Write here rather than stdout')
+    parser.add_argument('--resume', action='store_true',
+                        help='Keep the entries already in --output and continue after them')
+    main(parser.parse_args())
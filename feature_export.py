@@ -2,13 +2,32 @@
 import sys
 import argparse
 import logging
-from Bio import SeqIO
+import multiprocessing
+from Bio.Data import CodonTable
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 from Bio.SeqFeature import SeqFeature, FeatureLocation
+import genbank
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger()
 
+try:  # py2
+    from StringIO import StringIO
+except ImportError:  # py3
+    from io import StringIO
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Records handed to each worker at a time with --jobs
+SHARD_RECORDS = 50
+# Qualifiers used in IDs and deflines, the rest are not parsed
+QUALIFIERS = ('locus_tag', 'gene', 'product')
+# Characters of FASTA collected before each write
+WRITE_BUFFER = 1024 * 1024
+
 
 def get_id(feature=None, parent_prefix=None):
     result = ""
@@ -26,6 +45,117 @@ def get_id(feature=None, parent_prefix=None):
     return result
 
 
+class AmbiguousSequence(ValueError):
+    pass
+
+
+class Translator(object):
+    """Table driven translation of plain ACGT sequence.
+
+    Gives the same result as Biopython's ``translate(cds=True)``, falling
+    back to ``translate(cds=False)`` when the CDS checks fail, while only
+    translating the sequence once. Anything containing ambiguity codes
+    raises AmbiguousSequence so that it can be left to Biopython.
+    """
+    BASES = 'TCAG'
+
+    def __init__(self, table_id=11):
+        table = CodonTable.unambiguous_dna_by_id[int(table_id)]
+        self.starts = frozenset(table.start_codons)
+        self.stops = frozenset(table.stop_codons)
+        # As in Biopython, codons which are both a stop and an amino acid are
+        # translated as the amino acid.
+        self.codons = {}
+        for a in self.BASES:
+            for b in self.BASES:
+                for c in self.BASES:
+                    codon = a + b + c
+                    self.codons[codon] = table.forward_table.get(codon, '*')
+
+        if numpy is not None:
+            self.index = numpy.full(256, 255, dtype=numpy.uint8)
+            for i, base in enumerate(self.BASES):
+                self.index[ord(base)] = i
+            self.amino_acids = numpy.array(
+                [ord(self.codons[a + b + c]) for a in self.BASES for b in self.BASES for c in self.BASES],
+                dtype=numpy.uint8)
+
+    def translate(self, sequence):
+        """Translate every whole codon of upper case ``sequence``"""
+        n = len(sequence) - len(sequence) % 3
+        if numpy is not None:
+            bases = self.index[numpy.frombuffer(sequence[:n].encode('ascii'), dtype=numpy.uint8)]
+            if (bases == 255).any():
+                raise AmbiguousSequence(sequence)
+            codons = bases[0::3] * 16 + bases[1::3] * 4 + bases[2::3]
+            return self.amino_acids[codons].tobytes().decode('ascii')
+
+        try:
+            return ''.join([self.codons[sequence[i:i + 3]] for i in range(0, n, 3)])
+        except KeyError:
+            raise AmbiguousSequence(sequence)
+
+    def translate_cds(self, sequence):
+        """Return ``(protein, problem)``.
+
+        ``problem`` is None if ``sequence`` is a valid CDS, in which case the
+        start is translated as M and the stop dropped. Otherwise it says what
+        was wrong, and every codon is translated as is.
+        """
+        sequence = sequence.upper()
+        return self.check_cds(sequence, self.translate(sequence))
+
+    def translate_many(self, sequences):
+        """``translate_cds`` of each of ``sequences``, or None for those
+        with ambiguity codes.
+
+        With NumPy the whole batch is translated in one pass, which saves
+        the per call overhead that dominates for gene sized sequences.
+        """
+        sequences = [x.upper() for x in sequences]
+        if numpy is None or not sequences:
+            results = []
+            for sequence in sequences:
+                try:
+                    results.append(self.check_cds(sequence, self.translate(sequence)))
+                except AmbiguousSequence:
+                    results.append(None)
+            return results
+
+        # Each is cut to whole codons, so the codons stay aligned end to end
+        lengths = [len(x) - len(x) % 3 for x in sequences]
+        bases = self.index[numpy.frombuffer(
+            ''.join(x[:n] for (x, n) in zip(sequences, lengths)).encode('ascii'), dtype=numpy.uint8)]
+        ambiguous = numpy.concatenate(([0], numpy.cumsum(bases == 255)))
+        bases[bases == 255] = 0
+        proteins = self.amino_acids[bases[0::3] * 16 + bases[1::3] * 4 + bases[2::3]].tobytes().decode('ascii')
+
+        results = []
+        start = 0
+        for sequence, n in zip(sequences, lengths):
+            if ambiguous[start + n] != ambiguous[start]:
+                results.append(None)
+            else:
+                results.append(self.check_cds(sequence, proteins[start // 3:(start + n) // 3]))
+            start += n
+        return results
+
+    def check_cds(self, sequence, protein):
+        """``translate_cds`` given the upper case ``sequence`` and its
+        ``translate``"""
+        if sequence[:3] not in self.starts:
+            problem = "First codon '%s' is not a start codon" % sequence[:3]
+        elif len(sequence) % 3 != 0:
+            problem = "Sequence length %s is not a multiple of three" % len(sequence)
+        elif sequence[-3:] not in self.stops:
+            problem = "Final codon '%s' is not a stop codon" % sequence[-3:]
+        elif '*' in protein[1:-1]:
+            problem = 'Extra in frame stop codon found.'
+        else:
+            return 'M' + protein[1:-1], None
+        return protein, problem
+
+
 def ensure_location_in_bounds(start=0, end=0, parent_length=0):
     # This prevents frameshift errors
     while start < 0:
@@ -43,7 +173,13 @@ def extract_features(genbank_file=None, tag='CDS', translate=False,
                      n_bases_upstream=0, n_bases_downstream=0,
                      strip_stops=False, translation_table_id=11, informative=False):
 
-    for record in SeqIO.parse(genbank_file, "genbank"):
+    translator = Translator(translation_table_id)
+    if isinstance(tag, str):
+        tag = [tag]
+    for record in genbank.scan(genbank_file, features=tag, qualifiers=QUALIFIERS):
+        # Every feature of the record is extracted first, so that all of
+        # them can be translated in one batch
+        extracted = []
         for feature in record.features:
             if feature.type in tag:
                 # Find new feature boundaries
@@ -80,39 +216,133 @@ def extract_features(genbank_file=None, tag='CDS', translate=False,
                                                              strand=strand),
                                              type='domain'))
 
-                if translate:
-                    extracted_seqs = []
-                    for x in __seqs:
+                extracted.append((feature, start, end, [(x, x.extract(record.seq)) for x in __seqs]))
+
+        if translate:
+            translations = iter(translator.translate_many(
+                [str(nucleotides) for (_, _, _, parts) in extracted for (_, nucleotides) in parts]))
+
+        for feature, start, end, parts in extracted:
+            if translate:
+                extracted_seqs = []
+                for x, nucleotides in parts:
+                    translated = next(translations)
+                    if translated is not None:
+                        y, problem = translated
+                        if problem is not None:
+                            log.warn("WARN %s %s %s", record.name, get_id(x), problem)
+                        extracted_seqs.append(y)
+                        continue
+
+                    # Ambiguity codes, which are left to Biopython
+                    try:
+                        y = nucleotides.translate(table=translation_table_id, cds=True)
+                        extracted_seqs.append(y)
+                    except Exception as bdct:
+                        log.warn("WARN %s %s %s", record.name, get_id(x), bdct)
                         try:
-                            y = x.extract(record.seq).translate(table=translation_table_id, cds=True)
+                            y = nucleotides.translate(table=translation_table_id, cds=False)
                             extracted_seqs.append(y)
-                        except Exception, bdct:
-                            log.warn("WARN %s %s %s", record.name, get_id(x), bdct)
-                            try:
-                                y = x.extract(record.seq).translate(table=translation_table_id, cds=False)
-                                extracted_seqs.append(y)
-                            except Exception, bcdt2:
-                                log.warn("ERROR %s %s %s", record.name, get_id(x), bcdt2)
-                else:
-                    extracted_seqs = [x.extract(record.seq) for x in __seqs]
+                        except Exception as bcdt2:
+                            log.warn("ERROR %s %s %s", record.name, get_id(x), bcdt2)
+            else:
+                extracted_seqs = [nucleotides for (_, nucleotides) in parts]
+
+            if informative:
+                defline = ' %s [start=%s,end=%s]' % (','.join(feature.qualifiers.get('product', [])), start, end)
+            else:
+                defline = ' [start=%s,end=%s]' % (start, end)
+
+            extracted_seq = ''.join(map(str, extracted_seqs))
+
+            if strip_stops:
+                extracted_seq = extracted_seq.replace('*', '')
+
+            yield [
+                SeqRecord(
+                    Seq(extracted_seq.strip()),
+                    id='gb|%s|lcl|%s' % (record.name,  get_id(feature)),
+                    description=defline
+                )
+            ]
+
+
+def format_fasta(record, width=60):
+    """The FASTA text SeqIO.write would produce for ``record``"""
+    description = record.description.replace('\n', ' ')
+    if description and description.split(None, 1)[0] == record.id:
+        title = description
+    elif description:
+        title = '%s %s' % (record.id, description)
+    else:
+        title = record.id
+    sequence = str(record.seq)
+    lines = ['>' + title]
+    lines.extend(sequence[i:i + width] for i in range(0, len(sequence), width))
+    return '\n'.join(lines) + '\n'
+
+
+def write_fasta(batches, output, buffer_size=WRITE_BUFFER):
+    """Write the records in each of ``batches`` to ``output``, collecting
+    about ``buffer_size`` characters per write."""
+    pending = []
+    size = 0
+    for batch in batches:
+        for record in batch:
+            text = format_fasta(record)
+            pending.append(text)
+            size += len(text)
+        if size >= buffer_size:
+            output.write(''.join(pending))
+            pending = []
+            size = 0
+    if pending:
+        output.write(''.join(pending))
+
+
+def split_records(handle, per_shard=SHARD_RECORDS):
+    """Yield the text of ``per_shard`` GenBank records at a time, split on
+    the ``//`` record terminators."""
+    lines = []
+    records = 0
+    for line in handle:
+        lines.append(line)
+        if line.startswith('//'):
+            records += 1
+            if records == per_shard:
+                yield ''.join(lines)
+                lines = []
+                records = 0
+    if any(line.strip() for line in lines):
+        yield ''.join(lines)
+
+
+def _export_shard(args):
+    text, kwargs = args
+    out = StringIO()
+    write_fasta(extract_features(genbank_file=StringIO(text), **kwargs), out)
+    return out.getvalue()
 
-                if informative:
-                    defline = ' %s [start=%s,end=%s]' % (','.join(feature.qualifiers.get('product', [])), start, end)
-                else:
-                    defline = ' [start=%s,end=%s]' % (start, end)
 
-                extracted_seq = ''.join(map(str, extracted_seqs))
+def export_features(genbank_file=None, output=sys.stdout, jobs=1, **kwargs):
+    """Write the FASTA for extract_features to ``output``.
 
-                if strip_stops:
-                    extracted_seq = extracted_seq.replace('*', '')
+    With more than one job the input is split at record boundaries and the
+    shards are processed on a pool of ``jobs`` processes. Output is written
+    in input order regardless.
+    """
+    if jobs <= 1:
+        write_fasta(extract_features(genbank_file=genbank_file, **kwargs), output)
+        return
 
-                yield [
-                    SeqRecord(
-                        Seq(extracted_seq.strip()),
-                        id='gb|%s|lcl|%s' % (record.name,  get_id(feature)),
-                        description=defline
-                    )
-                ]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        shards = ((text, kwargs) for text in split_records(genbank_file))
+        for fasta in pool.imap(_export_shard, shards):
+            output.write(fasta)
+    finally:
+        pool.close()
+        pool.join()
 
 
 if __name__ == '__main__':
@@ -133,7 +363,7 @@ if __name__ == '__main__':
                 "tmRNA", "transit_peptide", "unsure", "variation"]
 
     parser = argparse.ArgumentParser(description='Export a subset of features from a Genbank file', epilog="")
-    parser.add_argument('genbank_file', type=file, help='Genbank file')
+    parser.add_argument('genbank_file', type=argparse.FileType('r'), help='Genbank file')
     parser.add_argument('tag', nargs='+', type=str, choices=gbk_tags, help='tags to export')
 
     parser.add_argument('--translate', action='store_true', help='Translate sequence')
@@ -142,7 +372,7 @@ if __name__ == '__main__':
     parser.add_argument('--n_bases_downstream', type=int, help='Add N bases downstream to exported features', default=0)
     parser.add_argument('--strip_stops', action='store_true', help='Remove stop codons')
     parser.add_argument('--informative', action='store_true', help='More informative deflines')
+    parser.add_argument('--jobs', type=int, help='Number of worker processes', default=1)
 
     args = vars(parser.parse_args())
-    for seq in extract_features(**args):
-        SeqIO.write(seq, sys.stdout, 'fasta')
+    export_features(**args)
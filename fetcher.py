@@ -0,0 +1,491 @@
+#!/usr/bin/env python
+"""Concurrent HTTP/FTP downloader.
+
+Files are fetched into ``<dest>.part`` and renamed into place once complete,
+so a file existing under its final name is always whole. Large files can be
+split into byte ranges which are fetched over several connections and
+written straight into place in the ``.part`` file.
+"""
+import os
+import json
+import time
+import ftplib
+import datetime
+import hashlib
+import socket
+import logging
+import threading
+from collections import deque
+
+try:  # py3
+    from urllib.request import Request, urlopen
+    from urllib.parse import urlparse
+    from urllib.error import HTTPError
+    from http.client import HTTPException
+except ImportError:  # py2
+    from urllib2 import Request, urlopen, HTTPError
+    from urlparse import urlparse
+    from httplib import HTTPException
+
+log = logging.getLogger('dl.fetch')
+
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT = 300
+# Transfer.rate covers roughly the last this many seconds
+RATE_WINDOW = 30
+MONTHS = dict((name, number) for (number, name) in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1))
+
+
+def parse_listing(text, now=None):
+    """The files in an ``ls -l`` style directory listing, as served for FTP
+    directories, as a list of ``{'name', 'size', 'mtime'}`` dicts.
+
+    ``mtime`` is an ISO 8601 string in the server's time zone. Listings
+    give the time of day rather than the year for recent files, in which
+    case the year is the latest that does not put them in the future.
+    """
+    now = now or datetime.datetime.now()
+    files = []
+    for line in text.splitlines():
+        fields = line.split(None, 8)
+        if len(fields) < 9 or not fields[0].startswith('-') or not fields[4].isdigit():
+            continue
+        month = MONTHS.get(fields[5][:3].title())
+        if month is None or not fields[6].isdigit():
+            continue
+        day = int(fields[6])
+        try:
+            if ':' in fields[7]:
+                hour, minute = (int(x) for x in fields[7].split(':'))
+                mtime = datetime.datetime(now.year, month, day, hour, minute)
+                if mtime > now + datetime.timedelta(days=1):
+                    mtime = mtime.replace(year=now.year - 1)
+            else:
+                mtime = datetime.datetime(int(fields[7]), month, day)
+        except ValueError:
+            continue
+        files.append({
+            'name': fields[8].strip(),
+            'size': int(fields[4]),
+            'mtime': mtime.isoformat(),
+        })
+    return files
+
+
+class ChecksumError(IOError):
+    pass
+
+
+class RangeNotSatisfiable(IOError):
+    """The server has nothing past the offset asked for"""
+    pass
+
+
+class DownloadResult(object):
+
+    def __init__(self, url, path):
+        self.url = url
+        self.path = path
+        self.bytes = 0
+        self.interval = 0
+        self.skipped = False
+        self.error = None
+        self.digests = {}
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def throughput(self):
+        """Bytes per second actually transferred"""
+        if not self.interval:
+            return 0
+        return self.bytes / self.interval
+
+
+class Transfer(object):
+    """Progress of a download in flight, for reporting while it runs"""
+
+    def __init__(self, url, path):
+        self.url = url
+        self.path = path
+        self.start = time.time()
+        # Already on disk from an earlier, interrupted attempt
+        self.offset = 0
+        self.bytes = 0
+        self.size = None
+        self.samples = deque([(self.start, 0)])
+
+    def add(self, count):
+        self.bytes += count
+        now = time.time()
+        if now - self.samples[-1][0] >= 1:
+            self.samples.append((now, self.bytes))
+            while now - self.samples[0][0] > RATE_WINDOW:
+                self.samples.popleft()
+
+    @property
+    def done(self):
+        return self.offset + self.bytes
+
+    @property
+    def rate(self):
+        """Recent bytes per second, which falls towards 0 if it stalls"""
+        then, count = self.samples[0]
+        elapsed = time.time() - then
+        return (self.bytes - count) / elapsed if elapsed > 0 else 0
+
+    @property
+    def eta(self):
+        """Seconds until complete at the recent rate, or None if unknown"""
+        rate = self.rate
+        if self.size is None or not rate:
+            return None
+        return max(self.size - self.done, 0) / rate
+
+
+class Downloader(object):
+    """Fetch many URLs at once.
+
+    ``per_host`` bounds the number of open connections to any one server,
+    ranges included. Files larger than ``split_size`` bytes are fetched as
+    ``ranges`` parallel byte ranges when the server allows it.
+    """
+
+    def __init__(self, per_host=4, split_size=None, ranges=4):
+        self.per_host = per_host
+        self.split_size = split_size
+        self.ranges = ranges
+        self.lock = threading.Lock()
+        self.hosts = {}
+        # Transfer per destination currently being downloaded, and the bytes
+        # of those already finished
+        self.transfers = {}
+        self.completed_bytes = 0
+
+    def host_slot(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self.hosts[host]
+
+    # Protocol specifics. Each of these opens its own connection.
+    def remote_size(self, url):
+        """Size in bytes of the remote file, or None if unknown"""
+        parsed = urlparse(url)
+        with self.host_slot(url):
+            if parsed.scheme == 'ftp':
+                ftp = self._ftp(parsed)
+                try:
+                    ftp.voidcmd('TYPE I')
+                    return ftp.size(parsed.path)
+                except ftplib.error_perm:
+                    return None
+                finally:
+                    ftp.close()
+
+            request = Request(url)
+            request.get_method = lambda: 'HEAD'
+            try:
+                response = urlopen(request, timeout=TIMEOUT)
+            except HTTPError:
+                return None
+            length = response.headers.get('Content-Length')
+            response.close()
+            if length is None:
+                return None
+            return int(length)
+
+    def _ftp(self, parsed):
+        ftp = ftplib.FTP(timeout=TIMEOUT)
+        ftp.connect(parsed.hostname, parsed.port or 21)
+        ftp.login(parsed.username or 'anonymous', parsed.password or 'anonymous@')
+        return ftp
+
+    def in_flight(self):
+        """Transfers currently in progress"""
+        with self.lock:
+            return list(self.transfers.values())
+
+    def _stream(self, url, offset=0, length=None, transfer=None):
+        """Yield chunks of the remote file starting at ``offset``.
+
+        At most ``length`` bytes are produced if it is given. The size of the
+        file is recorded on ``transfer`` if the server says what it is.
+        """
+        parsed = urlparse(url)
+        remaining = length
+        if parsed.scheme == 'ftp':
+            ftp = self._ftp(parsed)
+            try:
+                ftp.voidcmd('TYPE I')
+                size = None
+                if transfer is not None or (offset and length is None):
+                    try:
+                        size = ftp.size(parsed.path)
+                    except ftplib.error_perm:
+                        pass
+                if transfer is not None:
+                    transfer.size = size
+                # As for HTTP's 416, rather than an empty transfer
+                if offset and length is None and size is not None and offset >= size:
+                    raise RangeNotSatisfiable('Nothing past byte %s of %s' % (offset, url))
+                conn = ftp.transfercmd('RETR ' + parsed.path, rest=offset or None)
+                try:
+                    while remaining is None or remaining > 0:
+                        want = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+                        chunk = conn.recv(want)
+                        if not chunk:
+                            break
+                        if remaining is not None:
+                            remaining -= len(chunk)
+                        yield chunk
+                finally:
+                    conn.close()
+                if length is None:
+                    ftp.voidresp()
+            finally:
+                # A range stops reading mid-transfer, which leaves the
+                # control connection in no state to be reused.
+                ftp.close()
+        else:
+            request = Request(url)
+            if offset or length is not None:
+                end = '' if length is None else str(offset + length - 1)
+                request.add_header('Range', 'bytes=%s-%s' % (offset, end))
+            try:
+                response = urlopen(request, timeout=TIMEOUT)
+            except HTTPError as e:
+                # Resuming a .part file that may already be complete
+                if e.code == 416 and offset and length is None:
+                    raise RangeNotSatisfiable('Nothing past byte %s of %s' % (offset, url))
+                raise
+            try:
+                if offset and response.getcode() != 206:
+                    raise IOError('Server ignored range request for %s' % url)
+                size = response.headers.get('Content-Length')
+                if transfer is not None and size is not None:
+                    transfer.size = int(size) + offset
+                if remaining is None and size is not None:
+                    # So that a body cut short is not taken for all of it
+                    remaining = int(size)
+                while remaining is None or remaining > 0:
+                    want = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+                    chunk = response.read(want)
+                    if not chunk:
+                        break
+                    if remaining is not None:
+                        remaining -= len(chunk)
+                    yield chunk
+            finally:
+                response.close()
+
+        if remaining:
+            raise IOError('Connection closed with %s bytes of %s outstanding' % (remaining, url))
+
+    # Single files
+    def fetch(self, url, dest, tee=None, expected=None, digests=()):
+        """Download ``url`` to ``dest``, returning a DownloadResult.
+
+        Existing files are left alone, and an existing ``.part`` file is
+        resumed. If ``tee`` is given every byte of the file, including any
+        resumed portion, is also written to it in order.
+
+        Each hashlib algorithm named in ``digests`` or ``expected`` is
+        computed as the data arrives and stored in ``result.digests``. If a
+        digest does not match its ``expected`` hex value the ``.part`` file
+        is removed, nothing is renamed into place, and ``result.error`` is a
+        ChecksumError.
+        """
+        result = DownloadResult(url, dest)
+        if os.path.exists(dest):
+            result.skipped = True
+            return result
+
+        expected = expected or {}
+        hashers = dict((name, hashlib.new(name)) for name in set(digests) | set(expected))
+        part = dest + '.part'
+        start = time.time()
+        transfer = Transfer(url, dest)
+        with self.lock:
+            self.transfers[dest] = transfer
+        try:
+            size = None
+            if self.split_size is not None and tee is None:
+                size = self.remote_size(url)
+
+            if size is not None and size > self.split_size and self.ranges > 1:
+                transfer.size = size
+                result.bytes = self._fetch_ranges(url, part, size, transfer)
+                # Ranges arrive out of order, so these are hashed once the
+                # file is complete, while it is still in the page cache.
+                if hashers:
+                    with open(part, 'rb') as handle:
+                        for chunk in iter(lambda: handle.read(CHUNK_SIZE), b''):
+                            for hasher in hashers.values():
+                                hasher.update(chunk)
+            else:
+                result.bytes = self._fetch_whole(url, part, tee=tee, hashers=hashers, transfer=transfer,
+                                                 verified=bool(expected))
+
+            result.digests = dict((name, hasher.hexdigest()) for (name, hasher) in hashers.items())
+            for name, value in sorted(expected.items()):
+                if result.digests[name] != value.lower():
+                    os.unlink(part)
+                    raise ChecksumError('%s mismatch for %s: expected %s, got %s' % (
+                        name, url, value.lower(), result.digests[name]))
+            os.rename(part, dest)
+        except (IOError, OSError, EOFError, socket.error, ftplib.Error, HTTPException) as e:
+            log.warning('Download of %s failed: %s', url, e)
+            result.error = e
+            # Nothing worth resuming, e.g. the file does not exist
+            if os.path.exists(part) and os.path.getsize(part) == 0:
+                os.unlink(part)
+        finally:
+            with self.lock:
+                del self.transfers[dest]
+                self.completed_bytes += transfer.bytes
+        result.interval = time.time() - start
+        return result
+
+    def _fetch_whole(self, url, part, tee=None, hashers=None, transfer=None, verified=False):
+        """Fetch ``url`` into ``part`` in one piece, resuming it if it is
+        there. A server with nothing past the end of ``part`` is only taken
+        to mean that it is complete if ``verified``, i.e. the caller will
+        check the digests. Otherwise it is fetched again from the start."""
+        transfer = transfer or Transfer(url, part)
+        progress_file = part + '.ranges'
+        if os.path.exists(progress_file):
+            # Written by _fetch_ranges, so full size with holes in it rather
+            # than a prefix of the file that could be resumed
+            log.info('Discarding the ranged download of %s', url)
+            os.unlink(progress_file)
+            if os.path.exists(part):
+                os.unlink(part)
+        try:
+            return self.__fetch_whole(url, part, tee, list((hashers or {}).values()), transfer)
+        except RangeNotSatisfiable:
+            if verified:
+                return 0
+            os.unlink(part)
+            if tee is not None:
+                # Which already has the start of the file
+                raise IOError('Cannot tell whether %s was complete, so it was removed' % part)
+            log.warning('Cannot tell whether %s is complete, fetching it again', part)
+            for hasher in (hashers or {}):
+                hashers[hasher] = hashlib.new(hasher)
+            transfer.offset = 0
+            return self.__fetch_whole(url, part, tee, list((hashers or {}).values()), transfer)
+
+    def __fetch_whole(self, url, part, tee, hashers, transfer):
+        offset = 0
+        if os.path.exists(part):
+            offset = os.path.getsize(part)
+            transfer.offset = offset
+            log.info('Resuming %s at %s bytes', url, offset)
+            if tee is not None or hashers:
+                with open(part, 'rb') as handle:
+                    for chunk in iter(lambda: handle.read(CHUNK_SIZE), b''):
+                        for hasher in hashers:
+                            hasher.update(chunk)
+                        if tee is not None:
+                            tee.write(chunk)
+
+        transferred = 0
+        with self.host_slot(url):
+            with open(part, 'ab' if offset else 'wb') as handle:
+                for chunk in self._stream(url, offset=offset, transfer=transfer):
+                    handle.write(chunk)
+                    for hasher in hashers:
+                        hasher.update(chunk)
+                    if tee is not None:
+                        tee.write(chunk)
+                    transferred += len(chunk)
+                    transfer.add(len(chunk))
+        return transferred
+
+    def _fetch_ranges(self, url, part, size, transfer=None):
+        # Completed ranges are recorded alongside the .part file so that an
+        # interrupted download only refetches the unfinished ones.
+        progress_file = part + '.ranges'
+        completed = set()
+        if os.path.exists(part) and os.path.exists(progress_file):
+            with open(progress_file, 'r') as handle:
+                completed = set(tuple(x) for x in json.load(handle))
+        else:
+            with open(part, 'wb') as handle:
+                handle.truncate(size)
+            # Marks the .part file as ranged from the start, so that it is
+            # never mistaken for a prefix to be resumed
+            with open(progress_file, 'w') as handle:
+                json.dump([], handle)
+
+        step = -(-size // self.ranges)
+        ranges = [(offset, min(step, size - offset)) for offset in range(0, size, step)]
+        transfer = transfer or Transfer(url, part)
+        transfer.offset = sum(length for (_, length) in completed)
+        errors = []
+        transferred = [0]
+        lock = threading.Lock()
+
+        def worker(offset, length):
+            try:
+                with self.host_slot(url):
+                    with open(part, 'r+b') as handle:
+                        handle.seek(offset)
+                        for chunk in self._stream(url, offset=offset, length=length):
+                            handle.write(chunk)
+                            with lock:
+                                transferred[0] += len(chunk)
+                                transfer.add(len(chunk))
+                with lock:
+                    completed.add((offset, length))
+                    with open(progress_file, 'w') as handle:
+                        json.dump(sorted(completed), handle)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=r) for r in ranges if r not in completed]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+        os.unlink(progress_file)
+        return transferred[0]
+
+    # Many files
+    def remote_sizes(self, urls):
+        """``remote_size`` of each URL, looked up ``per_host`` at a time"""
+        pending = list(urls)
+        sizes = {}
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    url = pending.pop(0)
+                try:
+                    size = self.remote_size(url)
+                except (IOError, OSError, EOFError, socket.error, ftplib.Error, HTTPException) as e:
+                    log.warning('Could not find the size of %s: %s', url, e)
+                    size = None
+                with lock:
+                    sizes[url] = size
+
+        threads = [threading.Thread(target=worker) for _ in range(min(self.per_host, len(pending)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+        return sizes
@@ -1,10 +1,17 @@
 #!/usr/bin/env python
 import os
+import re
 import sys
-import glob
+import json
+import shutil
+import argparse
 
 START_TAG = '## START AUTOGENERATED. DO NOT MODIFY MANUALLY ##'
 END_TAG = '## END AUTOGENERATED ##'
+BLAST_ROOT = '/media/nfs-backup/blast'
+# Written by download.py
+CATALOG = 'catalog.json'
+SNAPSHOT_DIR = re.compile(r'^\d{4}-\d{2}$')
 
 
 SPECIAL_SNOWFLAKES = {
@@ -55,117 +62,83 @@ NUCL_DBS = [
     'nt'
 ]
 
-PROT_LOC = []
-NUCL_LOC = []
 
-for db in PROT_DBS:
-    if isinstance(db, list):
-        dir_name, index_name, title = db
-    else:
-        dir_name = db
-        index_name = db
-        if db == 'nr':
-            title = 'NR'
-        else:
-            title = db[0].upper() + db[1:]
-
-    for date in sorted(glob.glob('%s/*' % dir_name))[::-1]:
-        date = date.split('/')[1]
-        if date in SPECIAL_SNOWFLAKES[dir_name]:
-            year, month = date.split('-')
-            key, title = SPECIAL_SNOWFLAKES[dir_name][date]
-            PROT_LOC.append([
-                key,
-                '[Permanent] ' + title,
-                '/media/nfs-backup/blast/%s/%s-%s/%s' % (dir_name, year, month, index_name)
-            ])
-        else:
-            year, week = date.split('-')
-            week = int(week)
-            permanence = ''
-            if week % 13 == 0:
-                permanence = '[Permanent] '
-
-            PROT_LOC.append([
-                '%s_%s.%s' % (index_name, year, week),
-                '%s%s %s-%s' % (permanence, title, year, week + 1),
-                '/media/nfs-backup/blast/%s/%s-%02d/%s' % (dir_name, year, week, index_name)
-            ])
-
-for db in NUCL_DBS:
-    if isinstance(db, list):
-        dir_name, index_name, title = db
-    else:
-        dir_name = db
-        index_name = db
-        if db == 'nt':
-            title = 'NT'
+def snapshots_from_catalog(path):
+    """Snapshot dates of each database directory, from download.py's catalog"""
+    with open(path, 'r') as handle:
+        catalog = json.load(handle)
+    snapshots = {}
+    for entry in catalog:
+        snapshots.setdefault(entry['database'], set()).add(entry['date'])
+    return snapshots
+
+
+def snapshots_from_disk(root):
+    """Snapshot dates of each database directory, in one sweep of ``root``"""
+    snapshots = {}
+    for db in os.listdir(root):
+        db_path = os.path.join(root, db)
+        if not os.path.isdir(db_path):
+            continue
+        snapshots[db] = set(
+            x for x in os.listdir(db_path)
+            if SNAPSHOT_DIR.match(x) and os.path.isdir(os.path.join(db_path, x))
+        )
+    return snapshots
+
+
+def loc_entries(dbs, generic_title, snapshots):
+    """Loc file rows for every snapshot of ``dbs``, newest first"""
+    rows = []
+    for db in dbs:
+        if isinstance(db, list):
+            dir_name, index_name, title = db
         else:
-            title = db[0].upper() + db[1:]
-
-    for date in sorted(glob.glob('%s/*' % dir_name))[::-1]:
-        date = date.split('/')[1]
-        if date in SPECIAL_SNOWFLAKES[dir_name]:
-            year, month = date.split('-')
-            key, title = SPECIAL_SNOWFLAKES[dir_name][date]
-            NUCL_LOC.append([
-                key,
-                '[Permanent] ' + title,
-                '/media/nfs-backup/blast/%s/%s-%s/%s' % (dir_name, year, month, index_name)
-            ])
-        else:
-            year, week = date.split('-')
-            week = int(week)
-            permanence = ''
-            if week % 13 == 0:
-                permanence = '[Permanent] '
-            NUCL_LOC.append([
-                '%s_%s.%s' % (index_name, year, week),
-                '%s%s %s-%s' % (permanence, title, year, week + 1),
-                '/media/nfs-backup/blast/%s/%s-%02d/%s' % (dir_name, year, week, index_name)
-            ])
-
-NUCL_FILE = sys.argv[1]
-PROT_FILE = sys.argv[2]
-
-with open(NUCL_FILE, 'r+') as handle:
-    data = handle.readlines()
-    file_lines = []
+            dir_name = db
+            index_name = db
+            if db in generic_title:
+                title = generic_title[db]
+            else:
+                title = db[0].upper() + db[1:]
+
+        special = SPECIAL_SNOWFLAKES.get(dir_name, {})
+        for date in sorted(snapshots.get(dir_name, ()))[::-1]:
+            if date in special:
+                year, month = date.split('-')
+                key, special_title = special[date]
+                rows.append([
+                    key,
+                    '[Permanent] ' + special_title,
+                    '%s/%s/%s-%s/%s' % (BLAST_ROOT, dir_name, year, month, index_name)
+                ])
+            else:
+                year, week = date.split('-')
+                week = int(week)
+                permanence = ''
+                if week % 13 == 0:
+                    permanence = '[Permanent] '
+
+                rows.append([
+                    '%s_%s.%s' % (index_name, year, week),
+                    '%s%s %s-%s' % (permanence, title, year, week + 1),
+                    '%s/%s/%s-%02d/%s' % (BLAST_ROOT, dir_name, year, week, index_name)
+                ])
+    return rows
+
+
+def update_loc(path, rows):
+    """Replace the autogenerated section of the loc file at ``path``.
+
+    The file is only rewritten if its content changes, and then via a
+    temporary file renamed over it, so Galaxy never sees it half written.
+    Returns whether it changed.
+    """
+    with open(path, 'r') as handle:
+        original = handle.read()
 
-    in_replacement = False
-    for line in data:
-        line = line.strip()
-        if line == START_TAG:
-            in_replacement = True
-            # This will be our marker
-            file_lines.append(None)
-        elif line == END_TAG:
-            in_replacement = False
-        elif not in_replacement:
-            file_lines.append(line)
-
-    none_idx = file_lines.index(None)
-    first_half = file_lines[0:none_idx]
-    second_half = file_lines[none_idx+1:]
-
-    new_file_lines = \
-        first_half + [START_TAG] + \
-        ['\t'.join(x) for x in NUCL_LOC]
-
-    if 'BUILD_URL' in os.environ:
-        new_file_lines += ['# Automated build: ' + os.environ['BUILD_URL']]
-
-    new_file_lines += [END_TAG] + second_half
-    handle.seek(0)
-    handle.truncate()
-    handle.write('\n'.join(new_file_lines))
-
-with open(PROT_FILE, 'r+') as handle:
-    data = handle.readlines()
     file_lines = []
-
     in_replacement = False
-    for line in data:
+    for line in original.splitlines():
         line = line.strip()
         if line == START_TAG:
             in_replacement = True
@@ -182,13 +155,38 @@ with open(PROT_FILE, 'r+') as handle:
 
     new_file_lines = \
         first_half + [START_TAG] + \
-        ['\t'.join(x) for x in PROT_LOC]
+        ['\t'.join(x) for x in rows]
 
     if 'BUILD_URL' in os.environ:
         new_file_lines += ['# Automated build: ' + os.environ['BUILD_URL']]
 
     new_file_lines += [END_TAG] + second_half
-    handle.seek(0)
-    handle.truncate()
-    handle.write('\n'.join(new_file_lines))
+    content = '\n'.join(new_file_lines)
+    if content == original:
+        return False
+
+    tmp = os.path.join(os.path.dirname(os.path.abspath(path)), '.%s.tmp' % os.path.basename(path))
+    with open(tmp, 'w') as handle:
+        handle.write(content)
+    shutil.copymode(path, tmp)
+    os.rename(tmp, path)
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Update the autogenerated sections of Galaxy\'s BLAST loc files')
+    parser.add_argument('nucl_loc', help='blastdb.loc')
+    parser.add_argument('prot_loc', help='blastdb_p.loc')
+    parser.add_argument('--catalog', default=CATALOG,
+                        help='Catalog written by download.py. If missing, the database directories are listed instead')
+    args = parser.parse_args()
+
+    if os.path.exists(args.catalog):
+        snapshots = snapshots_from_catalog(args.catalog)
+    else:
+        snapshots = snapshots_from_disk('.')
 
+    for (path, dbs, generic_title) in ((args.nucl_loc, NUCL_DBS, {'nt': 'NT'}),
+                                       (args.prot_loc, PROT_DBS, {'nr': 'NR'})):
+        if update_loc(path, loc_entries(dbs, generic_title, snapshots)):
+            sys.stderr.write('Updated %s\n' % path)
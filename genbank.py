@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""Minimal streaming GenBank scanner.
+
+SeqIO builds a complete SeqRecord for every entry, parsing every feature,
+qualifier and reference whether or not it is used. ``scan`` only parses the
+handful of header fields the scripts here need, the features of the
+requested types and, optionally, the sequence. Everything else is skipped
+line by line, so memory use stays at one record regardless of input size.
+
+Fields that are parsed match what SeqIO would have produced for them.
+"""
+from Bio.Seq import Seq
+from Bio.SeqFeature import SeqFeature
+
+try:
+    from Bio.SeqFeature import Location
+    parse_location = Location.fromstring
+except (ImportError, AttributeError):  # Biopython < 1.81
+    from Bio.GenBank import _FeatureConsumer
+
+    def parse_location(text, length=None, circular=False, stranded=True):
+        consumer = _FeatureConsumer(use_fuzziness=1)
+        consumer._expected_size = length
+        consumer._seq_type = 'DNA' if stranded else 'PROTEIN'
+        consumer.data = type('record', (object,), {})()
+        consumer.data.annotations = {'topology': 'circular' if circular else 'linear'}
+        consumer._cur_feature = SeqFeature()
+        consumer.location(text)
+        return consumer._cur_feature.location
+
+INDENT = 12
+FEATURE_INDENT = 21
+# Keywords which end the feature table
+FOOTERS = ('ORIGIN', 'CONTIG', 'BASE COUNT', 'WGS')
+# Keywords whose continuation lines are joined with a space
+HEADER_FIELDS = ('DEFINITION', 'ACCESSION', 'VERSION', 'SOURCE')
+
+
+class Record(object):
+    """The parts of a GenBank entry that were asked for.
+
+    ``features`` is empty and ``seq`` None unless requested.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.id = None
+        self.description = ''
+        self.source = None
+        self.length = None
+        self.circular = False
+        self.protein = False
+        self.features = []
+        self.seq = None
+
+
+def _locus(line):
+    fields = line.split()
+    record = Record(fields[1] if len(fields) > 1 else '')
+    if len(fields) > 3 and fields[3] in ('bp', 'aa', 'rc') and fields[2].isdigit():
+        record.length = int(fields[2])
+        record.protein = fields[3] == 'aa'
+    record.circular = 'circular' in [x.lower() for x in fields[3:]]
+    return record
+
+
+def _header(record, keyword, data):
+    if keyword == 'DEFINITION':
+        # The period is GenBank syntax rather than part of the description
+        if data.endswith('.'):
+            data = data[:-1]
+        record.description = data
+    elif keyword == 'SOURCE':
+        record.source = data[:-1] if data.endswith('.') else data
+    elif keyword == 'ACCESSION':
+        accessions = data.replace(';', ' ').split()
+        if accessions and record.id is None:
+            record.id = accessions[0]
+    elif keyword == 'VERSION':
+        while '  ' in data:
+            data = data.replace('  ', ' ')
+        version = data.split(' GI:')[0]
+        if version:
+            record.id = version
+
+
+def _qualifier(qualifiers, key, value):
+    # As Bio.GenBank's feature consumer does it
+    if value is None:
+        qualifiers.setdefault(key, [''])
+        return
+    if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+        value = value[1:-1]
+    value = value.replace('""', '"')
+    if key == 'translation':
+        value = ''.join(value.split())
+    qualifiers.setdefault(key, []).append(value)
+
+
+def _feature(record, key, lines, qualifier_names):
+    """Build a SeqFeature from the lines of one feature table entry, with
+    the column 21 indentation already removed."""
+    lines = iter(lines)
+    location = next(lines).strip()
+    pending = []
+    for line in lines:
+        if line.startswith('/') or (location.count('(') <= location.count(')') and location[-1:] != ','):
+            pending.append(line)
+            break
+        location += line.strip()
+    pending.extend(lines)
+
+    # Pair up qualifier keys and (possibly multi line) values
+    parsed = []
+    quoted = False
+    for line in pending:
+        if quoted:
+            parsed[-1][1] += ' ' + line
+            quoted = not line.endswith('"')
+        elif line.startswith('/'):
+            i = line.find('=')
+            if i == -1:
+                parsed.append([line[1:], None])
+                continue
+            value = line[i + 1:]
+            if value.startswith(' ') and value.lstrip().startswith('"'):
+                value = value.lstrip()
+            parsed.append([line[1:i], value])
+            quoted = value[:1] == '"' and (len(value) == 1 or not value.endswith('"'))
+            # A lone quote is kept as is, as SeqIO does
+            if value == '"':
+                quoted = False
+        elif parsed and parsed[-1][1] is not None:
+            parsed[-1][1] += ' ' + line
+
+    qualifiers = {}
+    for name, value in parsed:
+        if qualifier_names is None or name in qualifier_names:
+            _qualifier(qualifiers, name, value)
+
+    location = ''.join(location.split())
+    if 'replace' in location:
+        location = location[8:location.find(',')]
+    try:
+        location = parse_location(location, record.length, record.circular, not record.protein)
+    except ValueError:
+        location = None
+    return SeqFeature(location, type=key, qualifiers=qualifiers)
+
+
+def scan(handle, features=(), qualifiers=None, sequence=True):
+    """Yield a Record for every entry in ``handle``.
+
+    Only features whose type is in ``features`` are parsed, and of their
+    qualifiers only those named in ``qualifiers`` (all of them if None).
+    With ``sequence=False`` the ORIGIN block is skipped without being read
+    into memory.
+    """
+    features = frozenset(features)
+    if qualifiers is not None:
+        qualifiers = frozenset(qualifiers)
+
+    record = None
+    keyword = None
+    data = None
+    feature = None
+    seq = []
+    # header, features, sequence or skip (until the next record)
+    state = None
+
+    def flush_header():
+        if keyword in HEADER_FIELDS:
+            _header(record, keyword, data)
+
+    for line in handle:
+        if state == 'sequence' and not line.startswith('//'):
+            # Whitespace is removed in one go once the record is complete
+            seq.append(line[10:])
+            continue
+        line = line.rstrip('\r\n')
+        if line.startswith('LOCUS '):
+            record = _locus(line)
+            keyword = None
+            state = 'header'
+            continue
+        if record is None:
+            continue
+
+        if line.startswith('//'):
+            if state == 'header':
+                flush_header()
+            if feature is not None:
+                record.features.append(_feature(record, *feature, qualifier_names=qualifiers))
+                feature = None
+            if state is not None and sequence:
+                record.seq = Seq(''.join(''.join(seq).split()).upper())
+            if record.id is None:
+                record.id = record.name
+            yield record
+            record = None
+            seq = []
+            state = None
+            continue
+
+        if state == 'header':
+            if line[:INDENT].strip() == '' and keyword is not None:
+                if keyword in HEADER_FIELDS:
+                    data += ' ' + line[INDENT:].rstrip()
+                continue
+            flush_header()
+            keyword = line[:INDENT].strip()
+            data = line[INDENT:].strip()
+            if keyword == 'FEATURES':
+                state = 'features' if features else 'skip'
+                keyword = None
+            elif keyword.startswith(FOOTERS):
+                state = 'sequence' if sequence and keyword == 'ORIGIN' else 'skip'
+                keyword = None
+        elif state == 'features':
+            if line[:1] not in ('', ' '):
+                if feature is not None:
+                    record.features.append(_feature(record, *feature, qualifier_names=qualifiers))
+                    feature = None
+                state = 'sequence' if sequence and line.startswith('ORIGIN') else 'skip'
+                continue
+            key = line[5:FEATURE_INDENT].strip()
+            if key:
+                if feature is not None:
+                    record.features.append(_feature(record, *feature, qualifier_names=qualifiers))
+                feature = (key, [line[FEATURE_INDENT:]]) if key in features else None
+            elif feature is not None and line.strip():
+                feature[1].append(line[FEATURE_INDENT:].strip())
+        elif state == 'skip' and sequence and line.startswith('ORIGIN'):
+            state = 'sequence'
@@ -2,10 +2,15 @@
 import os
 import sys
 import time
+import hashlib
 import datetime
 import logging
+import threading
 import subprocess
 
+from fetcher import ChecksumError, Downloader
+from journal import Journal, discard, partial
+
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger('dl')
@@ -14,6 +19,11 @@ SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 DOWNLOAD_ROOT = os.getcwd()
 VERSION = '5.22-61.0'
 PANTHER_VERSION = '11.1'
+# Completed steps for this version's install
+JOURNAL = os.path.join(DOWNLOAD_ROOT, 'journal-interpro-%s.sqlite' % VERSION)
+# InterProScan and PANTHER are fetched side by side from the same server
+CONNECTIONS_PER_HOST = 4
+INTERPRO_URL = 'ftp://ftp.ebi.ac.uk/pub/software/unix/iprscan/5/'
 
 
 class Timer:
@@ -46,29 +56,35 @@ class XUnitReportBuilder(object):
         }
         self.test_cases = []
         self.suite_name = suite_name
+        # InterProScan and PANTHER report from their own threads
+        self.lock = threading.RLock()
 
     def ok(self, classname, test_name, time=0):
         log.info("OK: [%s] %s", classname, test_name)
-        self.xunit_data['total'] += 1
-        self.__add_test(test_name, classname, errors="", time=time)
+        with self.lock:
+            self.xunit_data['total'] += 1
+            self.__add_test(test_name, classname, errors="", time=time)
 
     def error(self, classname, test_name, errorMessage, errorDetails="", time=0):
         log.info("ERROR: [%s] %s", classname, test_name)
-        self.xunit_data['total'] += 1
-        self.__add_test(test_name, classname, errors=self.ERROR_TPL.format(
-            errorMessage=errorMessage, errorDetails=errorDetails, test_name=test_name), time=time)
+        with self.lock:
+            self.xunit_data['total'] += 1
+            self.__add_test(test_name, classname, errors=self.ERROR_TPL.format(
+                errorMessage=errorMessage, errorDetails=errorDetails, test_name=test_name), time=time)
 
     def failure(self, classname, test_name, errorMessage, errorDetails="", time=0):
         log.info("FAIL: [%s] %s", classname, test_name)
-        self.xunit_data['total'] += 1
-        self.__add_test(test_name, classname, errors=self.ERROR_TPL.format(
-            errorMessage=errorMessage, errorDetails=errorDetails, test_name=test_name), time=time)
+        with self.lock:
+            self.xunit_data['total'] += 1
+            self.__add_test(test_name, classname, errors=self.ERROR_TPL.format(
+                errorMessage=errorMessage, errorDetails=errorDetails, test_name=test_name), time=time)
 
     def skip(self, classname, test_name, time=0):
         log.info("SKIP: [%s] %s", classname, test_name)
-        self.xunit_data['skips'] += 1
-        self.xunit_data['total'] += 1
-        self.__add_test(test_name, classname, errors="            <skipped />", time=time)
+        with self.lock:
+            self.xunit_data['skips'] += 1
+            self.xunit_data['total'] += 1
+            self.__add_test(test_name, classname, errors="            <skipped />", time=time)
 
     def __add_test(self, name, classname, errors, time=0):
         t = 'time="%s"' % time
@@ -76,18 +92,28 @@ class XUnitReportBuilder(object):
             self.TESTCASE_TPL.format(name=name, error=errors, classname=classname, time=t))
 
     def serialize(self):
-        self.xunit_data['test_cases'] = '\n'.join(self.test_cases)
-        self.xunit_data['suite_name'] = self.suite_name
-        return self.XUNIT_TPL.format(**self.xunit_data)
+        with self.lock:
+            self.xunit_data['test_cases'] = '\n'.join(self.test_cases)
+            self.xunit_data['suite_name'] = self.suite_name
+            return self.XUNIT_TPL.format(**self.xunit_data)
 
 
 xunit = XUnitReportBuilder('interpro_installer')
+journal = Journal(JOURNAL)
+downloader = Downloader(per_host=CONNECTIONS_PER_HOST)
 
 
-def timedCommand(classname, testname, errormessage, test_file, command, shell=False, cwd=None):
-    if os.path.exists(test_file):
+def timedCommand(classname, testname, errormessage, test_file, command, shell=False, cwd=None, inputs=()):
+    if journal.completed(classname, testname, test_file):
         xunit.skip(classname, testname)
+        return True
     else:
+        # Anything already there was left behind by an interrupted run
+        discard(test_file)
+        # Commands which name their output write it under a temporary name,
+        # renamed into place only once they have succeeded.
+        staged = partial(test_file)
+        command = [staged if x == test_file else x for x in command]
         try:
             if not cwd:
                 cwd = DOWNLOAD_ROOT
@@ -99,44 +125,171 @@ def timedCommand(classname, testname, errormessage, test_file, command, shell=Fa
                     command = ' '.join(command)
 
                 subprocess.check_call(command, shell=shell, cwd=cwd)
+                if os.path.exists(staged):
+                    os.rename(staged, test_file)
+            if not os.path.exists(test_file):
+                xunit.failure(classname, testname, errormessage,
+                              errorDetails='Exited successfully without writing %s' % test_file, time=t.interval)
+                return False
+            journal.commit(classname, testname, test_file, inputs=inputs, duration=t.interval)
             xunit.ok(classname, testname, time=t.interval)
+            return True
         except subprocess.CalledProcessError as cpe:
             xunit.failure(classname, testname, errormessage, errorDetails=str(cpe), time=t.interval)
-            raise Exception("Cannot continute")
+            return False
+
+
+def read_md5(path):
+    """Checksum from an ``md5sum`` style file, or None"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as handle:
+        fields = handle.read().split()
+    if not fields:
+        return None
+    return fields[0]
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def remove_extracted(contents, cwd):
+    """Remove what tar listed in ``contents`` as extracted into ``cwd``,
+    leaving any directory which still holds something else"""
+    if not os.path.exists(contents):
+        return
+    with open(contents, 'r') as handle:
+        names = [line.strip() for line in handle if line.strip()]
+    directories = set()
+    for name in names:
+        # GNU tar refuses these anyway, but never go outside cwd
+        if os.path.isabs(name) or os.path.pardir in name.split('/'):
+            continue
+        path = os.path.join(cwd, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            directories.add(path)
+        elif os.path.lexists(path):
+            os.unlink(path)
+    # Deepest first
+    for path in sorted(directories, reverse=True):
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+    os.unlink(contents)
 
 
-def interpro():
-    classname = 'interpro'
-    extracted_dir = os.path.join(DOWNLOAD_ROOT, 'interproscan-' + VERSION)
-    data_dir = os.path.join(extracted_dir, 'data')
-    tarball = 'interproscan-%s-64-bit.tar.gz' % VERSION
+def install_tarball(classname, steps, url, tarball, test_file, cwd):
+    """Download ``url`` to ``tarball``, checking it against the published
+    ``.md5`` as it arrives, and extract it in ``cwd`` at the same time.
 
-    panther_tarball = 'panther-data-%s.tar.gz' % PANTHER_VERSION
-    panther_tarball_md5 = panther_tarball + '.md5'
-    base_data_url = 'ftp://ftp.ebi.ac.uk/pub/software/unix/iprscan/5/data/'
-    # wget
-    md5sum = tarball + '.md5'
-    base_url = 'ftp://ftp.ebi.ac.uk/pub/software/unix/iprscan/5/%s/' % VERSION
-
-    timedCommand(classname, 'download.tarball', 'Download failed', tarball, [
-        'wget',
-        base_url + tarball,
-        '-O', tarball,
-    ])
-
-    timedCommand(classname, 'download.md5sum', 'Download failed', md5sum, [
-        'wget',
-        base_url + md5sum,
-        '-O', md5sum,
-    ])
-
-    timedCommand(classname, 'contents.verify', 'MD5SUM failed to validate', os.path.join(extracted_dir, 'interproscan.sh'), [
-        'md5sum', '-c', md5sum
-    ])
-
-    timedCommand(classname, 'contents.extract', 'Failed to extract', os.path.join(extracted_dir, 'interproscan.sh'), [
-        'tar', 'xvfz', tarball
-    ])
+    ``steps`` names the download and extract steps in the report. A tarball
+    which was downloaded by an earlier run is extracted from disk, once it
+    is known to match. Returns whether ``test_file`` was extracted.
+    """
+    download_step, extract_step = steps
+
+    def extract_from_disk():
+        return timedCommand(classname, extract_step, 'Failed to extract', test_file, [
+            'tar', 'xfz', os.path.abspath(tarball)
+        ], cwd=cwd)
+
+    if journal.completed(classname, extract_step, test_file):
+        xunit.skip(classname, download_step)
+        xunit.skip(classname, extract_step)
+        return True
+    if journal.completed(classname, download_step, tarball):
+        xunit.skip(classname, download_step)
+        return extract_from_disk()
+
+    md5 = None
+    if downloader.fetch(url + '.md5', tarball + '.md5').ok:
+        md5 = read_md5(tarball + '.md5')
+    if md5 is None:
+        xunit.failure(classname, download_step, 'Download failed', errorDetails='No checksum at %s.md5' % url)
+        xunit.error(classname, extract_step, 'Dependency failed', errorDetails=download_step)
+        return False
+
+    if os.path.exists(tarball):
+        # Downloaded, but not journaled as such, so the fetch would skip it
+        with Timer() as t:
+            digest = file_md5(tarball)
+        if digest == md5.lower():
+            journal.commit(classname, download_step, tarball, duration=t.interval, checksums={'md5': digest})
+            xunit.ok(classname, download_step, time=t.interval)
+            return extract_from_disk()
+        log.warning('%s does not match %s.md5, downloading it again', tarball, url)
+        discard(tarball)
+
+    discard(test_file)
+    log.info('Extracting %s into %s as it downloads', url, cwd)
+    # What tar extracts, so that it can be removed again if the download
+    # turns out not to match
+    contents = tarball + '.contents'
+    with Timer() as t:
+        with open(contents, 'w') as listing:
+            tar = subprocess.Popen(['tar', 'xvfz', '-'], cwd=cwd, stdin=subprocess.PIPE, stdout=listing)
+            try:
+                result = downloader.fetch(url, tarball, tee=tar.stdin, expected={'md5': md5})
+            finally:
+                try:
+                    tar.stdin.close()
+                except (IOError, OSError):
+                    pass
+            code = tar.wait()
+
+    if result.ok:
+        journal.commit(classname, download_step, tarball, duration=result.interval, checksums=result.digests)
+        xunit.ok(classname, download_step, time=result.interval)
+    elif isinstance(result.error, ChecksumError):
+        log.info('Removing what was extracted from the bad download of %s', url)
+        remove_extracted(contents, cwd)
+        # Fetch the checksum again next time too, in case it was the stale one
+        discard(tarball + '.md5')
+        xunit.failure(classname, download_step, 'MD5SUM failed to validate',
+                      errorDetails=str(result.error), time=result.interval)
+    else:
+        xunit.failure(classname, download_step, 'Download failed',
+                      errorDetails=str(result.error), time=result.interval)
+
+    if not result.ok:
+        # Whatever tar made of it is redone once the download is
+        xunit.error(classname, extract_step, 'Dependency failed', errorDetails=download_step)
+        return False
+    if code != 0 or not os.path.exists(test_file):
+        xunit.failure(classname, extract_step, 'Failed to extract',
+                      errorDetails='tar exited %s' % code if code else '%s was not extracted' % test_file,
+                      time=t.interval)
+        return False
+    journal.commit(classname, extract_step, test_file, inputs=[tarball], duration=t.interval)
+    xunit.ok(classname, extract_step, time=t.interval)
+    return True
+
+
+def reporting_errors(classname, func, *args):
+    """A thread target running ``func``, which reports rather than loses
+    an unexpected exception"""
+    def target():
+        try:
+            func(*args)
+        except Exception as e:
+            log.exception('%s raised', func.__name__)
+            xunit.error(classname, func.__name__, 'Unhandled exception', errorDetails=str(e))
+    return target
+
+
+def interproscan(classname, url, tarball, extracted_dir):
+    extracted = install_tarball(classname, ('download.tarball', 'contents.extract'), url, tarball,
+                                os.path.join(extracted_dir, 'interproscan.sh'), DOWNLOAD_ROOT)
+    if not extracted:
+        for step in ('setup.phobius', 'setup.signalp'):
+            xunit.error(classname, step, 'Dependency failed', errorDetails='contents.extract')
+        return
 
     timedCommand(classname, 'setup.phobius', 'Failed to install phobius', os.path.join(extracted_dir, 'bin', 'phobius', '1.01', 'phobius.pl'), [
         'tar', 'xvfz', os.path.join(os.path.pardir, 'phobius.tgz')
@@ -146,31 +299,45 @@ def interpro():
         'tar', 'xvfz', os.path.join(os.path.pardir, 'signalp.tgz')
     ], cwd=extracted_dir)
 
-    timedCommand(classname, 'panther.download_tarball', 'Download failed', os.path.join(extracted_dir, 'data', panther_tarball), [
-        'wget',
-        base_data_url + panther_tarball,
-        '-O', os.path.join(extracted_dir, 'data', panther_tarball),
-    ])
 
-    timedCommand(classname, 'panther.download_md5sum', 'Download failed', os.path.join(extracted_dir, 'data', panther_tarball_md5), [
-        'wget',
-        base_data_url + panther_tarball_md5,
-        '-O', os.path.join(extracted_dir, 'data', panther_tarball_md5),
-    ])
+def interpro():
+    classname = 'interpro'
+    extracted_dir = os.path.join(DOWNLOAD_ROOT, 'interproscan-' + VERSION)
+    data_dir = os.path.join(extracted_dir, 'data')
+    tarball = 'interproscan-%s-64-bit.tar.gz' % VERSION
 
-    timedCommand(classname, 'panther.verify', 'MD5SUM failed to validate', os.path.join(extracted_dir, 'data', 'panther'), [
-        'md5sum', '-c', panther_tarball_md5
-    ], cwd=data_dir)
+    panther_tarball = 'panther-data-%s.tar.gz' % PANTHER_VERSION
+    base_data_url = INTERPRO_URL + 'data/'
+    base_url = INTERPRO_URL + '%s/' % VERSION
+
+    # PANTHER unpacks into the InterProScan tree, so that it can be
+    # downloaded and extracted while InterProScan is
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+
+    threads = [
+        threading.Thread(target=reporting_errors(classname, interproscan, classname, base_url + tarball,
+                                                 tarball, extracted_dir)),
+        threading.Thread(target=reporting_errors(classname, install_tarball, classname,
+                                                 ('panther.download_tarball', 'panther.extract'),
+                                                 base_data_url + panther_tarball,
+                                                 os.path.join(data_dir, panther_tarball),
+                                                 os.path.join(data_dir, 'panther'), data_dir)),
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # join() with a timeout keeps the main thread responsive to ^C
+        while thread.is_alive():
+            thread.join(1)
 
-    timedCommand(classname, 'panther.extract', 'Failed to extract', os.path.join(extracted_dir, 'data', 'panther'), [
-        'tar', 'xvfz', panther_tarball
-    ], cwd=data_dir)
 
 if __name__ == '__main__':
     try:
         interpro()
     except Exception:
-        pass
+        log.exception('Install failed')
     finally:
         # Write out the report
         with open(sys.argv[1], 'w') as handle:
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""Durable record of completed steps.
+
+A step only counts as done once it has been committed here, along with the
+size of each of its outputs. An output that is missing or has changed size
+since means the step is redone, so a file left behind by an interrupted
+command is never mistaken for a finished one.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS steps (
+    classname TEXT NOT NULL,
+    testname TEXT NOT NULL,
+    test_file TEXT NOT NULL,
+    inputs TEXT NOT NULL,
+    outputs TEXT NOT NULL,
+    checksums TEXT NOT NULL,
+    duration REAL NOT NULL,
+    finished REAL NOT NULL,
+    PRIMARY KEY (classname, testname, test_file)
+)
+"""
+
+
+def output_sizes(paths):
+    sizes = {}
+    for path in paths:
+        if os.path.isfile(path):
+            sizes[path] = os.path.getsize(path)
+        elif os.path.exists(path):
+            # Directories (and the like) only have to exist
+            sizes[path] = None
+        else:
+            return None
+    return sizes
+
+
+class Journal(object):
+    """The journal at ``path``, which is only opened (and created) when
+    first used"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.__db = None
+
+    @property
+    def db(self):
+        # Must be called with self.lock held
+        if self.__db is None:
+            self.__db = sqlite3.connect(self.path, check_same_thread=False)
+            with self.__db:
+                self.__db.execute(SCHEMA)
+        return self.__db
+
+    def completed(self, classname, testname, test_file):
+        """Whether the step was committed and its outputs are unchanged"""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT outputs FROM steps WHERE classname = ? AND testname = ? AND test_file = ?',
+                (classname, testname, test_file)
+            ).fetchone()
+        if row is None:
+            return False
+        recorded = json.loads(row[0])
+        return output_sizes(recorded) == recorded
+
+    def commit(self, classname, testname, test_file, outputs=None, inputs=(),
+               duration=0, checksums=None):
+        """Record a step as complete. ``outputs`` defaults to ``test_file``,
+        and every one of them must exist. A step with nothing to show for
+        itself, whose ``test_file`` is only a name, passes ``outputs=[]``."""
+        if outputs is None:
+            outputs = [test_file]
+        missing = [x for x in outputs if not os.path.exists(x)]
+        if missing:
+            raise IOError('%s %s did not write %s' % (classname, testname, ', '.join(missing)))
+        sizes = output_sizes(outputs)
+        with self.lock:
+            with self.db:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (classname, testname, test_file, json.dumps(list(inputs)),
+                     json.dumps(sizes), json.dumps(checksums or {}), duration, time.time())
+                )
+
+
+def partial(path):
+    """Where an output is written before being renamed into place"""
+    return path + '.part'
+
+
+def discard(path):
+    """Remove an incomplete output, if it is a plain file"""
+    for candidate in (path, partial(path)):
+        if os.path.isfile(candidate):
+            os.unlink(candidate)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""Live metrics in the Prometheus text format.
+
+``Publisher`` calls a ``collect`` function every ``interval`` seconds and
+writes what it returns to a file, which node_exporter's textfile collector
+can pick up, and/or serves it over HTTP on localhost at ``/metrics``. The
+file is written under a temporary name and renamed into place, so it is
+never seen half written.
+
+``collect`` returns a list of ``(name, type, help, samples)`` where
+``samples`` is a list of ``(labels, value)`` and ``labels`` a dict.
+"""
+import os
+import logging
+import threading
+
+try:  # py3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # py2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+log = logging.getLogger('dl.metrics')
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(metrics):
+    lines = []
+    for (name, kind, help_text, samples) in metrics:
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for (labels, value) in samples:
+            if value is None:
+                continue
+            if labels:
+                name_labels = '%s{%s}' % (name, ','.join(
+                    '%s="%s"' % (k, escape(v)) for (k, v) in sorted(labels.items())))
+            else:
+                name_labels = name
+            lines.append('%s %s' % (name_labels, repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Publisher(object):
+
+    def __init__(self, collect, path=None, port=None, interval=10):
+        self.collect = collect
+        self.path = path
+        self.port = port
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.threads = []
+        self.server = None
+
+    def text(self):
+        return render(self.collect())
+
+    def write(self):
+        part = self.path + '.part'
+        with open(part, 'w') as handle:
+            handle.write(self.text())
+        os.rename(part, self.path)
+
+    def __writer(self):
+        while not self.stopped.is_set():
+            try:
+                self.write()
+            except Exception:
+                # Metrics are a nicety, never a reason for a run to fail
+                log.exception('Could not write %s', self.path)
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        if self.path is not None:
+            self.threads.append(threading.Thread(target=self.__writer))
+        if self.port is not None:
+            publisher = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split('?')[0] not in ('/', '/metrics'):
+                        self.send_error(404)
+                        return
+                    body = publisher.text().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self.server = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+            self.threads.append(threading.Thread(target=self.server.serve_forever))
+            log.info('Serving metrics on http://127.0.0.1:%s/metrics', self.server.server_address[1])
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving, leaving the file with the final state"""
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self.threads:
+            thread.join()
+        if self.path is not None:
+            self.write()
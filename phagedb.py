@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+"""db.json, the summary of every phage genome in GenBank.
+
+``build`` loads db.json into a SQLite file with an index on each of the
+accession, name and source organism, so a single phage can be looked up
+without reading the whole JSON file::
+
+    python phagedb.py build db.json db.sqlite
+    python phagedb.py query db.sqlite accession KY056619
+    python phagedb.py query db.sqlite source 'Arthrobacter phage' --prefix
+
+Each match is printed as one JSON object per line, with the same keys as
+db.json.
+
+``refresh`` brings db.json up to date with NCBI without downloading every
+genome again. Only the accession.version list for the query is fetched;
+GenBank records are fetched for accessions that are new or have a new
+version, and entries which no longer match the query are dropped::
+
+    python phagedb.py refresh db.json 'txid28883[Organism:exp]'
+"""
+import os
+import sys
+import json
+import logging
+import sqlite3
+import argparse
+
+try:  # py2
+    from StringIO import StringIO
+except ImportError:  # py3
+    from io import StringIO
+
+from eutils import EUtils
+from genbank import scan
+
+log = logging.getLogger('phagedb')
+
+SCHEMA = """
+CREATE TABLE phages (
+    id TEXT NOT NULL,
+    accession TEXT NOT NULL,
+    name TEXT,
+    desc TEXT,
+    source TEXT
+);
+CREATE INDEX phages_id ON phages (id);
+CREATE INDEX phages_accession ON phages (accession);
+CREATE INDEX phages_name ON phages (name);
+CREATE INDEX phages_source ON phages (source);
+"""
+FIELDS = ('id', 'accession', 'name', 'source')
+COLUMNS = ('id', 'desc', 'name', 'source')
+
+
+class JsonArrayWriter(object):
+    """Write entries as they arrive, producing exactly the text that
+    ``json.dump(entries, handle, indent=2)`` would.
+
+    ``count`` is the number of entries already in a resumed file, which
+    must have been truncated just after the last one.
+    """
+
+    def __init__(self, handle, count=0):
+        self.handle = handle
+        self.count = count
+        self.encoder = json.JSONEncoder(indent=2)
+        # ',' on py3 and ', ' on py2, as json.dump uses
+        self.separator = self.encoder.item_separator
+
+    def write(self, entry):
+        text = self.encoder.encode(entry).replace('\n', '\n  ')
+        if self.count:
+            self.handle.write(self.separator + '\n  ' + text)
+        else:
+            self.handle.write('[\n  ' + text)
+        self.count += 1
+
+    def close(self):
+        self.handle.write('\n]' if self.count else '[]')
+
+
+class JsonLinesWriter(object):
+    """One JSON object per line"""
+
+    def __init__(self, handle, count=0):
+        self.handle = handle
+        self.count = count
+
+    def write(self, entry):
+        self.handle.write(json.dumps(entry) + '\n')
+        self.count += 1
+
+    def close(self):
+        pass
+
+
+WRITERS = {
+    'json': JsonArrayWriter,
+    'jsonl': JsonLinesWriter,
+}
+
+
+def resume_point(path, fmt):
+    """Return ``(offset, count, last_id)`` for the complete entries at the
+    start of a previous, possibly interrupted, run's output."""
+    offset = count = 0
+    last_id = current_id = None
+    position = 0
+    try:
+        handle = open(path, 'rb')
+    except IOError:
+        return 0, 0, None
+    with handle:
+        for line in handle:
+            if fmt == 'jsonl':
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    last_id = json.loads(line.decode('utf-8'))['id']
+                except ValueError:
+                    break
+                count += 1
+                offset = position + len(line)
+            elif line.startswith(b'    "id": '):
+                current_id = json.loads(b'{' + line.strip().rstrip(b',') + b'}')['id']
+            elif line.startswith(b'  }'):
+                # The end of an entry, nested values are indented further
+                count += 1
+                offset = position + 3
+                last_id = current_id
+            position += len(line)
+    return offset, count, last_id
+
+
+def summary(rec):
+    """The db.json entry for a genbank.Record"""
+    return {
+        'id': rec.id,
+        'desc': rec.description,
+        'name': rec.name,
+        'source': rec.source
+    }
+
+
+def accession(versioned):
+    """KY056619.1 -> KY056619"""
+    return versioned.rsplit('.', 1)[0] if versioned else versioned
+
+
+def build(json_file, db_file):
+    """Write the index of ``json_file`` to ``db_file``, replacing it in one
+    step once complete."""
+    with open(json_file, 'r') as handle:
+        entries = json.load(handle)
+
+    part = db_file + '.part'
+    if os.path.exists(part):
+        os.unlink(part)
+    db = sqlite3.connect(part)
+    try:
+        with db:
+            db.executescript(SCHEMA)
+            db.executemany(
+                'INSERT INTO phages VALUES (?, ?, ?, ?, ?)',
+                ((x['id'], accession(x['id']), x.get('name'), x.get('desc'), x.get('source'))
+                 for x in entries)
+            )
+    finally:
+        db.close()
+    os.rename(part, db_file)
+    return len(entries)
+
+
+def refresh(json_file, term, eutils, genbank_file=None):
+    """Update ``json_file`` to match the ESearch query ``term``, fetching
+    GenBank records only for the accession.versions it does not have.
+
+    Entries are kept in their existing order and new ones added at the end.
+    The fetched records are appended to ``genbank_file`` if given. Returns
+    the number of entries kept, added and removed.
+    """
+    with open(json_file, 'r') as handle:
+        entries = json.load(handle)
+    current = eutils.esearch(term, db='nuccore', idtype='acc')
+    wanted = set(current)
+    known = set(x['id'] for x in entries)
+    kept = [x for x in entries if x['id'] in wanted]
+    missing = [x for x in current if x not in known]
+    log.info('%s entries up to date, %s to fetch, %s to remove',
+             len(kept), len(missing), len(entries) - len(kept))
+
+    part = json_file + '.part'
+    genbank = open(genbank_file, 'a') if genbank_file else None
+    try:
+        with open(part, 'w') as handle:
+            writer = JsonArrayWriter(handle)
+            for entry in kept:
+                writer.write(entry)
+            added = 0
+            for batch, text in eutils.efetch(missing, rettype='gbwithparts'):
+                if genbank is not None:
+                    genbank.write(text)
+                fetched = 0
+                for rec in scan(StringIO(text), sequence=False):
+                    writer.write(summary(rec))
+                    fetched += 1
+                if fetched != len(batch):
+                    log.warning('Asked for %s records, got %s', len(batch), fetched)
+                added += fetched
+            writer.close()
+    finally:
+        if genbank is not None:
+            genbank.close()
+    os.rename(part, json_file)
+    return len(kept), added, len(entries) - len(kept)
+
+
+class PhageDB(object):
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise IOError('No such index: %s' % path)
+        self.db = sqlite3.connect(path)
+
+    def find(self, field, value, prefix=False, limit=None):
+        """Entries whose ``field`` (one of FIELDS) equals ``value``, or
+        starts with it if ``prefix`` is set."""
+        if field not in FIELDS:
+            raise ValueError('Cannot look up by %s' % field)
+        if prefix:
+            # A range rather than LIKE, so that the index is used
+            where = '%s >= ? AND %s < ?' % (field, field)
+            params = [value, value[:-1] + chr(ord(value[-1]) + 1)] if value else ['', u'\U0010ffff']
+        else:
+            where = '%s = ?' % field
+            params = [value]
+        query = 'SELECT %s FROM phages WHERE %s ORDER BY %s' % (', '.join(COLUMNS), where, field)
+        if limit is not None:
+            query += ' LIMIT %d' % limit
+        return [dict(zip(COLUMNS, row)) for row in self.db.execute(query, params)]
+
+    def get(self, acc):
+        """The entry for an accession, with or without its version"""
+        field = 'id' if '.' in acc else 'accession'
+        found = self.find(field, acc, limit=1)
+        return found[0] if found else None
+
+    def close(self):
+        self.db.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Build, query or refresh db.json and its index')
+    subparsers = parser.add_subparsers(dest='command')
+
+    build_parser = subparsers.add_parser('build', help='Index db.json')
+    build_parser.add_argument('json_file', help='db.json')
+    build_parser.add_argument('db_file', help='Index to write')
+
+    query_parser = subparsers.add_parser('query', help='Look up entries')
+    query_parser.add_argument('db_file', help='Index built with build')
+    query_parser.add_argument('field', choices=FIELDS, help='Field to match')
+    query_parser.add_argument('value', help='Value to look up')
+    query_parser.add_argument('--prefix', action='store_true', help='Match entries starting with value')
+    query_parser.add_argument('--limit', type=int, help='Return at most this many entries')
+
+    refresh_parser = subparsers.add_parser('refresh', help='Fetch new and updated entries from NCBI')
+    refresh_parser.add_argument('json_file', help='db.json')
+    refresh_parser.add_argument('term', help='ESearch query the entries should match')
+    refresh_parser.add_argument('--genbank', help='Append the fetched records to this file')
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        count = build(args.json_file, args.db_file)
+        sys.stderr.write('Indexed %s entries\n' % count)
+    elif args.command == 'query':
+        phages = PhageDB(args.db_file)
+        found = phages.find(args.field, args.value, prefix=args.prefix, limit=args.limit)
+        for entry in found:
+            sys.stdout.write(json.dumps(entry) + '\n')
+        sys.exit(0 if found else 1)
+    elif args.command == 'refresh':
+        eutils = EUtils(api_key=os.environ.get('NCBI_API_KEY'), email=os.environ.get('NCBI_EMAIL'))
+        kept, added, removed = refresh(args.json_file, args.term, eutils, genbank_file=args.genbank)
+        sys.stderr.write('Kept %s entries, added %s, removed %s\n' % (kept, added, removed))
+    else:
+        parser.print_help()
+        sys.exit(1)
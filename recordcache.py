@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""Local cache of the records EFetch returns, by accession.version.
+
+Each genome's text in each format (``rettype``) is stored in a file of its
+own, and indexed in ``cache.sqlite`` with its size and when it was last
+used. Once the files add up to more than ``max_size`` bytes, the least
+recently used are removed. Since an accession.version always names the same
+sequence, a cached record never goes stale.
+
+``efetch`` stands in for ``EUtils.efetch``, only asking NCBI for the
+records that are not cached::
+
+    cache = RecordCache('records', max_size=10 * 1024 ** 3)
+    for batch, hits, text in cache.efetch(eutils, eutils.versions(ids)):
+        ...
+"""
+import os
+import re
+import time
+import sqlite3
+import logging
+import threading
+
+from journal import partial
+
+log = logging.getLogger('dl.recordcache')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    rettype TEXT NOT NULL,
+    id TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL,
+    PRIMARY KEY (rettype, id)
+)
+"""
+# The genome a FASTA record came from: its own ID for rettype=fasta, and
+# the part before _cds_ or _prot_ for the fasta_cds_na and fasta_cds_aa
+# records of its features.
+FASTA_ID = re.compile(r'^>(?:lcl\|)?(\S+?)(?:_(?:cds|prot)_\S*)?(?:\s|$)')
+VERSION = re.compile(r'^VERSION +(\S+)', re.M)
+
+
+def split_records(text, rettype):
+    """Yield ``(id, text)`` for each genome in the EFetch output ``text``,
+    in order. ``id`` is None for anything that cannot be attributed."""
+    if rettype.startswith('gb'):
+        start = 0
+        while True:
+            end = text.find('\n//', start)
+            if end == -1:
+                break
+            end = text.find('\n', end + 1)
+            end = len(text) if end == -1 else end + 1
+            record = text[start:end]
+            start = end
+            version = VERSION.search(record)
+            yield version.group(1) if version else None, record
+        if text[start:].strip():
+            yield None, text[start:]
+        return
+
+    # FASTA, where consecutive records of one genome are kept together
+    record_id = None
+    lines = []
+    for line in text.splitlines(True):
+        if line.startswith('>'):
+            match = FASTA_ID.match(line)
+            line_id = match.group(1) if match else None
+            if lines and line_id != record_id:
+                yield record_id, ''.join(lines)
+                lines = []
+            record_id = line_id
+        lines.append(line)
+    if any(line.strip() for line in lines):
+        yield record_id, ''.join(lines)
+
+
+class RecordCache(object):
+    """The cache in ``directory``, which is only opened (and created) when
+    first used"""
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.__db = None
+
+    @property
+    def db(self):
+        # Must be called with self.lock held
+        if self.__db is None:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            self.__db = sqlite3.connect(os.path.join(self.directory, 'cache.sqlite'), check_same_thread=False)
+            with self.__db:
+                self.__db.execute(SCHEMA)
+            # In case max_size is smaller than last time
+            self.__evict()
+        return self.__db
+
+    def path(self, rettype, record_id):
+        # accession.versions are safe as file names, but be sure
+        return os.path.join(self.directory, rettype, re.sub(r'[^A-Za-z0-9_.-]', '_', record_id))
+
+    def get(self, rettype, ids):
+        """The cached text of each of ``ids`` which is cached, by ID"""
+        found = {}
+        with self.lock:
+            now = time.time()
+            with self.db:
+                for record_id in ids:
+                    row = self.db.execute('SELECT size FROM records WHERE rettype = ? AND id = ?',
+                                          (rettype, record_id)).fetchone()
+                    if row is None:
+                        continue
+                    try:
+                        with open(self.path(rettype, record_id), 'r') as handle:
+                            text = handle.read()
+                    except (IOError, OSError):
+                        text = None
+                    if text is None or len(text) != row[0]:
+                        # Removed or damaged since, so fetch it again
+                        self.db.execute('DELETE FROM records WHERE rettype = ? AND id = ?', (rettype, record_id))
+                        continue
+                    self.db.execute('UPDATE records SET used = ? WHERE rettype = ? AND id = ?',
+                                    (now, rettype, record_id))
+                    found[record_id] = text
+        return found
+
+    def put(self, rettype, records):
+        """Cache ``records``, a dict of text by ID, then evict the least
+        recently used records until the cache fits in ``max_size``."""
+        directory = os.path.join(self.directory, rettype)
+        with self.lock:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            now = time.time()
+            with self.db:
+                for record_id, text in records.items():
+                    path = self.path(rettype, record_id)
+                    with open(partial(path), 'w') as handle:
+                        handle.write(text)
+                    os.rename(partial(path), path)
+                    self.db.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)',
+                                    (rettype, record_id, len(text), now))
+            self.__evict()
+
+    def size(self):
+        with self.lock:
+            return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM records').fetchone()[0]
+
+    def __evict(self):
+        # Must be called with self.lock held
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM records').fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = self.db.execute('SELECT rettype, id, size FROM records ORDER BY used').fetchall()
+        with self.db:
+            for (rettype, record_id, size) in rows:
+                if total <= self.max_size:
+                    break
+                path = self.path(rettype, record_id)
+                if os.path.exists(path):
+                    os.unlink(path)
+                self.db.execute('DELETE FROM records WHERE rettype = ? AND id = ?', (rettype, record_id))
+                total -= size
+                log.debug('Evicted %s %s', rettype, record_id)
+
+    def efetch(self, eutils, ids, db='nuccore', rettype='gbwithparts', retmode='text'):
+        """Yield ``(batch, hits, text)`` for each of ``eutils.batches(ids)``,
+        with the records in order.
+
+        ``ids`` must be accession.versions (see ``EUtils.versions``). Only
+        those not cached are fetched, in one request per batch, and ``hits``
+        is how many came from the cache. Fetched records are only cached
+        once the batch has been yielded, so evicting them cannot lose any of
+        it.
+        """
+        for batch in eutils.batches(ids):
+            cached = self.get(rettype, batch)
+            missing = [x for x in batch if x not in cached]
+
+            fetched = {}
+            unattributed = []
+            if missing:
+                wanted = set(missing)
+                text = eutils.request('efetch.fcgi', {
+                    'db': db,
+                    'id': ','.join(missing),
+                    'rettype': rettype,
+                    'retmode': retmode,
+                })
+                for record_id, record in split_records(text, rettype):
+                    if record_id in wanted and record_id not in fetched:
+                        fetched[record_id] = record
+                    else:
+                        unattributed.append(record)
+                if unattributed:
+                    log.warning('%s of the %s records fetched could not be matched to the IDs asked for',
+                                len(unattributed), rettype)
+
+            yield batch, len(cached), ''.join(
+                [cached.get(x) or fetched.get(x, '') for x in batch] + unattributed)
+            if fetched:
+                self.put(rettype, fetched)